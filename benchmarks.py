@@ -0,0 +1,330 @@
+# coding: utf-8
+'''
+Microbenchmarks for myACARS hot paths.
+
+Seeds a temporary SQLite database with synthetic data and times the code
+paths used by smartCARS and by the public website. Results are written as
+JSON, and can be compared with the results of another revision:
+
+    python benchmarks.py -o before.json
+    git checkout other-revision
+    python benchmarks.py -o after.json --compare before.json
+'''
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def setup_app(tmpdir):
+    config = os.path.join(tmpdir, 'config.py')
+    with open(config, 'w') as fp:
+        fp.write('SQLALCHEMY_DATABASE_URI = %r\n' % (
+            'sqlite:///' + os.path.join(tmpdir, 'bench.db')))
+        fp.write('OFP_PATH = %r\n' % os.path.join(tmpdir, 'ofp'))
+        fp.write('GEOJSON_PATH = %r\n' % os.path.join(tmpdir, 'geojson'))
+        fp.write('LIVE_CACHE = %r\n' % 'memory')
+        fp.write('POSITION_WRITE_BEHIND = False\n')
+    os.environ['MYACARS_CONFIG'] = config
+
+    import myacars
+    return myacars
+
+
+def synthetic_track(flight_id, count, start, seed):
+    # ground holds with repeated reports at both ends of the flight
+    rand = random.Random(seed)
+    hold = count // 20
+    rv = []
+    for i in range(count):
+        j = min(max(i - hold, 0), count - 2 * hold)
+        frac = j / max(count - 2 * hold, 1)
+        airborne = 0 < j < count - 2 * hold
+        rv.append({
+            'flight_id': flight_id,
+            'latitude': -23.43 + 10 * frac + 0.05 * math.sin(j / 50),
+            'longitude': -46.47 + 20 * frac + 0.05 * math.cos(j / 70),
+            'altitude': int(35000 * math.sin(math.pi * frac))
+            if airborne else 0,
+            'heading': (45 + j // 100) % 360,
+            'ground_speed': rand.randint(420, 460) if airborne else 0,
+            'phase': 5 if airborne else 1,
+            'timestamp': start + timedelta(seconds=5 * i),
+        })
+    return rv
+
+
+def seed(m, client, args):
+    # only the models and the smartCARS API are used, so that the data is
+    # the same for every revision, and whatever a revision derives from it
+    # is kept up to date by the revision itself
+    db = m.db
+    db.create_all()
+
+    db.session.add_all([
+        m.Airport(
+            icao='B%03d' % (i % 1000) if i < 1000 else 'C%03d' % (i % 1000),
+            name='Synthetic Airport %d' % i,
+            latitude=-60 + (i * 7.3) % 120,
+            longitude=-180 + (i * 13.7) % 360,
+            country='BR',
+        )
+        for i in range(args.airports)
+    ])
+    db.session.add_all([
+        m.Aircraft(
+            icao='A320',
+            name='Airbus A320 #%d' % i,
+            registration='PR-A%02d' % i,
+            max_passengers=180,
+            max_cargo=1000,
+        )
+        for i in range(args.aircraft)
+    ])
+    db.session.commit()
+
+    def add_flight(num, start, log):
+        flt = m.Flight(
+            airline_icao='AAA',
+            flight_number=num,
+            origin_id=1 + num % args.airports,
+            destination_id=1 + (num + 1) % args.airports,
+            route='DCT',
+            flight_level=350,
+            aircraft_id=1 + num % args.aircraft,
+            log=log,
+            landing_rate=None if log is None else -150,
+            duration=None if log is None else 90,
+        )
+        db.session.add(flt)
+        db.session.flush()
+        db.session.execute(m.Position.__table__.insert(), synthetic_track(
+            flt.id, args.points, start, num))
+        return flt.id
+
+    now = datetime.utcnow()
+    completed = []
+    for i in range(args.flights):
+        start = now - timedelta(days=i + 1)
+        completed.append(add_flight(i + 1, start, 'Synthetic PIREP %d' % i))
+
+    # a bid being flown right now
+    bid = add_flight(args.flights + 1,
+                     now - timedelta(seconds=5 * args.points), None)
+    db.session.commit()
+    db.session.remove()
+
+    rv = client.post('/smartcars/?action=manuallogin&userid=%s&'
+                     'sessionid=bench' % m.app.config['USERID'],
+                     data={'password': m.app.config['PASSWORD']})
+    assert rv.data != b'AUTH_FAILED', rv.data
+    return completed, bid
+
+
+def run(m, args):
+    app, db = m.app, m.db
+    client = app.test_client()
+    completed, bid = seed(m, client, args)
+    flight = completed[0]
+    zoom = app.config.get('TRACK_ZOOM', 10)
+
+    def get(url, **kwargs):
+        rv = client.get(url, **kwargs)
+        assert rv.status_code in (200, 304), (url, rv.status_code)
+        return rv
+
+    reports = iter(range(10 ** 9))
+
+    def post_position(altitude):
+        rv = client.post(
+            '/smartcars/?action=positionreport&dbid=1&sessionid=bench&'
+            'bidid=%d&latitude=-23.5&longitude=-46.5&altitude=%d&'
+            'magneticheading=90&groundspeed=450&phase=5' % (bid, altitude),
+            data={'route': 'DCT'})
+        assert rv.data == b'SUCCESS', rv.data
+
+    def positionreport():
+        post_position(35000 + next(reports) % 100)
+
+    def positionreport_duplicate():
+        # identical reports are not stored
+        post_position(34000)
+
+    def positions_filtered():
+        db.session.expire_all()
+        m.Flight.query.get(bid).positions_filtered
+
+    def flight_geojson():
+        get('/flight/%d/geojson/?zoom=%d' % (bid, zoom))
+
+    def flight_geojson_artifact():
+        get('/flight/%d/geojson/?zoom=%d' % (flight, zoom))
+
+    def live_json():
+        get('/live/json/')
+
+    def get_stats():
+        m.get_stats()
+
+    def touch_airports():
+        # a change to the airports invalidates whatever is cached from them
+        apt = m.Airport.query.get(1)
+        apt.name = 'Synthetic Airport %d' % next(reports)
+        db.session.commit()
+
+    def getairports():
+        get('/smartcars/?action=getairports')
+
+    def getairports_cached():
+        get('/smartcars/?action=getairports',
+            headers={'Accept-Encoding': 'gzip'})
+
+    def getbidflights():
+        get('/smartcars/?action=getbidflights')
+
+    def home():
+        get('/')
+
+    # name, timed function, and what must happen before each round, outside
+    # of the timing. a new position changes the track of the bid.
+    benchmarks = [
+        ('positions_filtered', positions_filtered, None),
+        ('flight_geojson', flight_geojson, positionreport),
+        ('flight_geojson_cached', flight_geojson, None),
+        ('flight_geojson_artifact', flight_geojson_artifact, None),
+        ('live_json', live_json, None),
+        ('get_stats', get_stats, None),
+        ('getairports', getairports, touch_airports),
+        ('getairports_cached', getairports_cached, None),
+        ('getbidflights', getbidflights, None),
+        ('positionreport', positionreport, None),
+        ('positionreport_duplicate', positionreport_duplicate, None),
+        ('home', home, None),
+    ]
+
+    results = {}
+    with app.test_request_context():
+        # the bid is live from here on
+        positionreport()
+        for name, func, setup in benchmarks:
+            if args.filter and not any(i in name for i in args.filter):
+                continue
+            timings = []
+            for i in range(args.repeat + 1):
+                if setup is not None:
+                    setup()
+                start = time.perf_counter()
+                func()
+                timings.append(time.perf_counter() - start)
+            timings = timings[1:]  # warm up
+            results[name] = {
+                'min': min(timings),
+                'median': statistics.median(timings),
+                'mean': statistics.mean(timings),
+                'rounds': len(timings),
+            }
+            print('%-24s min %9.3fms  median %9.3fms' % (
+                name, results[name]['min'] * 1000,
+                results[name]['median'] * 1000))
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print()
+    print('%-24s %12s %12s %8s' % ('benchmark', 'baseline', 'current',
+                                   'ratio'))
+    for name, current in sorted(results.items()):
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        ratio = current['median'] / old['median']
+        flag = ''
+        if ratio > threshold:
+            flag = ' REGRESSION'
+            regressions.append(name)
+        print('%-24s %10.3fms %10.3fms %7.2fx%s' % (
+            name, old['median'] * 1000, current['median'] * 1000, ratio,
+            flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', default='bench_output.json',
+                        help='JSON file to store results')
+    parser.add_argument('-c', '--compare', metavar='JSON',
+                        help='results of a previous run to compare with')
+    parser.add_argument('-t', '--threshold', type=float, default=1.2,
+                        help='slowdown ratio reported as regression')
+    parser.add_argument('-r', '--repeat', type=int, default=20)
+    parser.add_argument('-k', '--filter', action='append',
+                        help='only run benchmarks containing this string')
+    parser.add_argument('--airports', type=int, default=5000)
+    parser.add_argument('--aircraft', type=int, default=20)
+    parser.add_argument('--flights', type=int, default=50)
+    parser.add_argument('--points', type=int, default=2000,
+                        help='positions per flight')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='myacars-bench-')
+    try:
+        m = setup_app(tmpdir)
+        with m.app.app_context():
+            results = run(m, args)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    data = {
+        'revision': git_revision(),
+        'date': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'numpy': getattr(getattr(m, 'numpy', None), '__version__', None),
+        'params': {
+            'airports': args.airports,
+            'aircraft': args.aircraft,
+            'flights': args.flights,
+            'points': args.points,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as fp:
+        json.dump(data, fp, indent=2, sort_keys=True)
+    print('Results stored in', args.output)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if baseline.get('params') != data['params']:
+            print('Warning: benchmark parameters differ from baseline')
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
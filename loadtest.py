@@ -0,0 +1,319 @@
+# coding: utf-8
+'''
+smartCARS traffic load generator for myACARS.
+
+Simulates smartCARS clients flying their bids, and browsers polling
+/live/json/, then reports throughput and p50/p95/p99 latency per action.
+Without --url the clients use the Flask test client of a throwaway instance,
+seeded with one synthetic bid per client in a temporary SQLite database:
+
+    python loadtest.py -c 10 -b 50
+
+The 'loadtest' manager command of myacars.py runs it as well, and can send
+the traffic to a running instance instead:
+
+    python myacars.py loadtest -u http://localhost:8000 -c 10
+'''
+
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+import requests
+
+Report = namedtuple('Report', ['latitude', 'longitude', 'altitude',
+                               'heading', 'ground_speed', 'phase'])
+
+
+def great_circle_track(origin, destination, count, flight_level):
+    lat1, lon1, lat2, lon2 = map(math.radians, origin + destination)
+    d = 2 * math.asin(math.sqrt(
+        math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) *
+        math.sin((lon2 - lon1) / 2) ** 2))
+    rv = []
+    for i in range(count):
+        f = i / max(count - 1, 1)
+        if d:
+            a = math.sin((1 - f) * d) / math.sin(d)
+            b = math.sin(f * d) / math.sin(d)
+            x = a * math.cos(lat1) * math.cos(lon1) + \
+                b * math.cos(lat2) * math.cos(lon2)
+            y = a * math.cos(lat1) * math.sin(lon1) + \
+                b * math.cos(lat2) * math.sin(lon2)
+            z = a * math.sin(lat1) + b * math.sin(lat2)
+            lat = math.atan2(z, math.sqrt(x * x + y * y))
+            lon = math.atan2(y, x)
+        else:
+            lat, lon = lat1, lon1
+        heading = math.degrees(math.atan2(
+            math.sin(lon2 - lon) * math.cos(lat2),
+            math.cos(lat) * math.sin(lat2) -
+            math.sin(lat) * math.cos(lat2) * math.cos(lon2 - lon)))
+
+        # climb and descent take 20% of the track each
+        profile = min(1, f / 0.2, (1 - f) / 0.2)
+        on_ground = i == 0 or i == count - 1
+        rv.append(Report(
+            latitude=math.degrees(lat),
+            longitude=math.degrees(lon),
+            altitude=int(flight_level * 100 * profile),
+            heading=int(heading) % 360,
+            ground_speed=0 if on_ground else int(150 + 300 * profile),
+            phase=1 if on_ground else (5 if profile == 1 else 4),
+        ))
+    return rv
+
+
+class LoadClient:
+
+    def __init__(self, target, stats):
+        # target is the base URL of a running instance, or a Flask app
+        self.stats = stats
+        if isinstance(target, str):
+            self.url = target
+            self.session = requests.Session()
+        else:
+            self.url = None
+            self.client = target.test_client()
+
+    def request(self, name, path, params, data=None):
+        method = 'GET' if data is None else 'POST'
+        start = time.perf_counter()
+        try:
+            if self.url is None:
+                resp = self.client.open(path, method=method,
+                                        query_string=params, data=data)
+                status, text = resp.status_code, resp.get_data(as_text=True)
+            else:
+                resp = self.session.request(method, self.url + path,
+                                            params=params, data=data)
+                status, text = resp.status_code, resp.text
+        except Exception:
+            status, text = None, ''
+        self.stats.record(name, time.perf_counter() - start,
+                          status == 200 and 'AUTH_FAILED' not in text and
+                          text != 'ERROR')
+        return text
+
+    def smartcars(self, action, data=None, **params):
+        params['action'] = action
+        return self.request(action, '/smartcars/', params, data)
+
+
+class LoadStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.errors = {}
+        self.failures = set()
+
+    def fail(self, message):
+        with self.lock:
+            self.failures.add(message)
+
+    def record(self, name, elapsed, ok):
+        with self.lock:
+            self.timings.setdefault(name, []).append(elapsed)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, elapsed):
+        def percentile(values, p):
+            return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+        print('%-18s %7s %7s %9s %9s %9s %9s' % (
+            'action', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+            'p99 ms'))
+        for name, values in sorted(self.timings.items()):
+            values = sorted(values)
+            print('%-18s %7d %7d %9.1f %9.1f %9.1f %9.1f' % (
+                name, len(values), self.errors.get(name, 0),
+                len(values) / elapsed, percentile(values, 50) * 1000,
+                percentile(values, 95) * 1000, percentile(values, 99) * 1000))
+
+
+def fly(num, target, stats, args, tracks):
+    client = LoadClient(target, stats)
+    sessionid = uuid.uuid4().hex
+    user = client.smartcars('manuallogin', {'password': args['password']},
+                            userid=args['userid'], sessionid=sessionid)
+    if user in ('AUTH_FAILED', ''):
+        stats.fail('manuallogin failed, check USERID and PASSWORD')
+        return
+    bids = client.smartcars('getbidflights')
+    if bids in ('NONE', ''):
+        stats.fail('getbidflights returned no bids to fly')
+        return
+    bid = bids.split(';')[num % len(bids.split(';'))].split('|')
+    track = tracks(bid)
+
+    interval = 1 / args['rate']
+    next_report = time.monotonic()
+    for pos in track:
+        client.smartcars(
+            'positionreport', {'route': bid[6]},
+            dbid='1', sessionid=sessionid, bidid=bid[0],
+            latitude=pos.latitude, longitude=pos.longitude,
+            altitude=pos.altitude, magneticheading=pos.heading,
+            groundspeed=pos.ground_speed, phase=pos.phase or 0)
+        next_report += interval
+        time.sleep(max(0, next_report - time.monotonic()))
+    if args['pirep']:
+        client.smartcars(
+            'filepirep', {'log': '[00:00:00] myACARS load test',
+                          'comments': 'load test', 'route': bid[6]},
+            dbid='1', sessionid=sessionid, bidid=bid[0], landingrate='-150',
+            flighttime='01.00')
+
+
+def browse(target, stats, interval, done):
+    client = LoadClient(target, stats)
+    while not done.is_set():
+        client.request('/live/json/', '/live/json/', {})
+        done.wait(interval)
+
+
+def run(target, clients, browsers, points, poll_interval, args, track=None):
+    '''
+    Flies a bid with each client while the browsers poll, then prints the
+    report. Tracks replay the given reports, or follow a great-circle route
+    between the airports of the bid.
+    '''
+    stats = LoadStats()
+    if track is not None:
+        def tracks(bid):
+            return track
+    else:
+        airports = {}
+        for apt in LoadClient(target, LoadStats()).smartcars(
+                'getairports').split(';'):
+            apt = apt.split('|')
+            if len(apt) == 6:
+                airports[apt[1]] = (float(apt[3]), float(apt[4]))
+
+        def tracks(bid):
+            return great_circle_track(airports[bid[4]], airports[bid[5]],
+                                      points, int(bid[7]) // 100)
+
+    browsers_done = threading.Event()
+    threads = [
+        threading.Thread(target=fly, args=(i, target, stats, args, tracks))
+        for i in range(clients)
+    ] + [
+        threading.Thread(target=browse,
+                         args=(target, stats, poll_interval, browsers_done))
+        for i in range(browsers)
+    ]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads[:clients]:
+        thread.join()
+    browsers_done.set()
+    for thread in threads[clients:]:
+        thread.join()
+    if stats.failures:
+        raise SystemExit('Load test failed: %s' %
+                         '; '.join(sorted(stats.failures)))
+    stats.report(time.monotonic() - start)
+
+
+def setup_app(tmpdir):
+    config = os.path.join(tmpdir, 'config.py')
+    with open(config, 'w') as fp:
+        fp.write('SQLALCHEMY_DATABASE_URI = %r\n' % (
+            'sqlite:///' + os.path.join(tmpdir, 'loadtest.db')))
+        fp.write('OFP_PATH = %r\n' % os.path.join(tmpdir, 'ofp'))
+        fp.write('GEOJSON_PATH = %r\n' % os.path.join(tmpdir, 'geojson'))
+        fp.write('LIVE_CACHE = %r\n' % 'memory')
+        fp.write('POSITION_WRITER_LOCK = %r\n' % os.path.join(
+            tmpdir, 'position-writer.lock'))
+    os.environ['MYACARS_CONFIG'] = config
+
+    import myacars
+    return myacars
+
+
+def seed(m, bids):
+    # airports spread over the globe, and bids not flown yet
+    m.db.create_all()
+    m.db.session.add_all([
+        m.Airport(icao='L%03d' % i, name='Synthetic Airport %d' % i,
+                  latitude=-60 + (i * 7.3) % 120,
+                  longitude=-180 + (i * 13.7) % 360, country='BR')
+        for i in range(1000)
+    ])
+    m.db.session.add_all([
+        m.Aircraft(icao='A320', name='Airbus A320 #%d' % i,
+                   registration='PR-L%02d' % i, max_passengers=180,
+                   max_cargo=1000)
+        for i in range(5)
+    ])
+    m.db.session.flush()
+    m.db.session.add_all([
+        m.Flight(airline_icao='AAA', flight_number=i + 1,
+                 origin_id=1 + i % 1000, destination_id=1 + (i + 1) % 1000,
+                 route='DCT', flight_level=350, aircraft_id=1 + i % 5)
+        for i in range(bids)
+    ])
+    m.db.session.commit()
+    m.db.session.remove()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--clients', type=int, default=1,
+                        help='number of simulated smartCARS clients')
+    parser.add_argument('-b', '--browsers', type=int, default=10,
+                        help='number of simulated browsers polling '
+                        '/live/json/')
+    parser.add_argument('-r', '--rate', type=float, default=1,
+                        help='position reports per second, per client')
+    parser.add_argument('-n', '--points', type=int, default=100,
+                        help='position reports per client (synthetic '
+                        'routes)')
+    parser.add_argument('-t', '--track', metavar='JSON',
+                        help='replay the reports stored in this file')
+    parser.add_argument('-i', '--poll-interval', type=float, default=15,
+                        help='seconds between browser polls')
+    parser.add_argument('--skip-pirep', action='store_true',
+                        help="don't file a pirep at the end of the flights")
+    args = parser.parse_args()
+
+    track = None
+    if args.track:
+        with open(args.track) as fp:
+            track = [Report(*i) for i in json.load(fp)]
+
+    tmpdir = tempfile.mkdtemp(prefix='myacars-loadtest-')
+    try:
+        m = setup_app(tmpdir)
+        seed(m, args.clients)
+        try:
+            run(m.app, args.clients, args.browsers, args.points,
+                args.poll_interval, {
+                    'userid': m.app.config['USERID'],
+                    'password': m.app.config['PASSWORD'],
+                    'rate': args.rate,
+                    'pirep': not args.skip_pirep,
+                }, track)
+        finally:
+            m.position_writer.flush()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
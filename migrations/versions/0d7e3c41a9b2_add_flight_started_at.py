@@ -0,0 +1,29 @@
+"""Add Flight.started_at
+
+Revision ID: 0d7e3c41a9b2
+Revises: f88b31e5aec4
+Create Date: 2026-10-18 12:15:52.302441
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0d7e3c41a9b2'
+down_revision = 'f88b31e5aec4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('flight', sa.Column('started_at', sa.DateTime(),
+                                      nullable=True))
+    op.execute(
+        'UPDATE flight SET started_at = (SELECT min(position.timestamp) '
+        'FROM position WHERE position.flight_id = flight.id)'
+    )
+
+
+def downgrade():
+    op.drop_column('flight', 'started_at')
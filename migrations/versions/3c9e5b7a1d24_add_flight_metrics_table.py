@@ -0,0 +1,44 @@
+"""Add FlightMetrics table
+
+Revision ID: 3c9e5b7a1d24
+Revises: 6a1f0c2d8e57
+Create Date: 2026-10-18 15:02:37.540218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9e5b7a1d24'
+down_revision = '6a1f0c2d8e57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing flights are filled in by the recompute_metrics command
+    op.create_table('flight_metrics',
+    sa.Column('flight_id', sa.Integer(), nullable=False),
+    sa.Column('positions', sa.Integer(), nullable=False),
+    sa.Column('distance', sa.Float(), nullable=False),
+    sa.Column('min_altitude', sa.Integer(), nullable=True),
+    sa.Column('max_altitude', sa.Integer(), nullable=True),
+    sa.Column('max_ground_speed', sa.Integer(), nullable=True),
+    sa.Column('cruise_time', sa.Float(), nullable=False),
+    sa.Column('cruise_distance', sa.Float(), nullable=False),
+    sa.Column('block_off', sa.DateTime(), nullable=True),
+    sa.Column('block_on', sa.DateTime(), nullable=True),
+    sa.Column('phases', sa.UnicodeText(), nullable=False),
+    sa.Column('last_latitude', sa.Float(), nullable=True),
+    sa.Column('last_longitude', sa.Float(), nullable=True),
+    sa.Column('last_ground_speed', sa.Integer(), nullable=True),
+    sa.Column('last_phase', sa.Integer(), nullable=True),
+    sa.Column('last_timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['flight_id'], ['flight.id'], ),
+    sa.PrimaryKeyConstraint('flight_id')
+    )
+
+
+def downgrade():
+    op.drop_table('flight_metrics')
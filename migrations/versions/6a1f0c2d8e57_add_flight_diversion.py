@@ -0,0 +1,32 @@
+"""Add Flight.diversion_id
+
+Revision ID: 6a1f0c2d8e57
+Revises: 0d7e3c41a9b2
+Create Date: 2026-10-18 14:40:12.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6a1f0c2d8e57'
+down_revision = '0d7e3c41a9b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('flight', sa.Column('diversion_id', sa.Integer(),
+                                      nullable=True))
+    # SQLite can't add constraints to existing tables
+    if op.get_context().dialect.name != 'sqlite':
+        op.create_foreign_key('flight_diversion_id_fkey', 'flight',
+                              'airport', ['diversion_id'], ['id'])
+
+
+def downgrade():
+    if op.get_context().dialect.name != 'sqlite':
+        op.drop_constraint('flight_diversion_id_fkey', 'flight',
+                           type_='foreignkey')
+    op.drop_column('flight', 'diversion_id')
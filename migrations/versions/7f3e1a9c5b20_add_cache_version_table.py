@@ -0,0 +1,33 @@
+"""Add CacheVersion table
+
+Revision ID: 7f3e1a9c5b20
+Revises: e4a7c9d2b635
+Create Date: 2026-10-18 20:31:09.214870
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7f3e1a9c5b20'
+down_revision = 'e4a7c9d2b635'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table = op.create_table(
+        'cache_version',
+        sa.Column('name', sa.String(length=32), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table, [
+        {'name': 'aircraft', 'version': 0},
+        {'name': 'airports', 'version': 0},
+    ])
+
+
+def downgrade():
+    op.drop_table('cache_version')
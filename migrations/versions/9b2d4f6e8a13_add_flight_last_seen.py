@@ -0,0 +1,33 @@
+"""Add Flight.last_seen
+
+Revision ID: 9b2d4f6e8a13
+Revises: 3c9e5b7a1d24
+Create Date: 2026-10-18 18:05:41.503117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b2d4f6e8a13'
+down_revision = '3c9e5b7a1d24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('flight', sa.Column('last_seen', sa.DateTime(),
+                                      nullable=True))
+    op.create_index(op.f('ix_flight_last_seen'), 'flight', ['last_seen'],
+                    unique=False)
+    op.execute(
+        'UPDATE flight SET last_seen = (SELECT max(position.timestamp) '
+        'FROM position WHERE position.flight_id = flight.id) '
+        'WHERE flight.log IS NULL'
+    )
+
+
+def downgrade():
+    op.drop_index(op.f('ix_flight_last_seen'), table_name='flight')
+    op.drop_column('flight', 'last_seen')
@@ -0,0 +1,42 @@
+"""Add indexes for hot queries
+
+Revision ID: b54ca27bc49e
+Revises: 4cd4b6eda720
+Create Date: 2026-10-18 10:12:31.448213
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b54ca27bc49e'
+down_revision = '4cd4b6eda720'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_session_sessionid'), 'session', ['sessionid'],
+                    unique=False)
+    op.create_index(op.f('ix_airport_icao'), 'airport', ['icao'],
+                    unique=False)
+    op.create_index('ix_flight_bids', 'flight', ['id'], unique=False,
+                    sqlite_where=sa.text('log IS NULL'),
+                    postgresql_where=sa.text('log IS NULL'))
+    op.create_index('ix_flight_complete', 'flight', ['id'], unique=False,
+                    sqlite_where=sa.text('log IS NOT NULL'),
+                    postgresql_where=sa.text('log IS NOT NULL'))
+    op.create_index(op.f('ix_position_timestamp'), 'position', ['timestamp'],
+                    unique=False)
+    op.create_index('ix_position_flight_id_timestamp', 'position',
+                    ['flight_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_position_flight_id_timestamp', table_name='position')
+    op.drop_index(op.f('ix_position_timestamp'), table_name='position')
+    op.drop_index('ix_flight_complete', table_name='flight')
+    op.drop_index('ix_flight_bids', table_name='flight')
+    op.drop_index(op.f('ix_airport_icao'), table_name='airport')
+    op.drop_index(op.f('ix_session_sessionid'), table_name='session')
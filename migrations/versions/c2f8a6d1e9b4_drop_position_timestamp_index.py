@@ -0,0 +1,28 @@
+"""Drop the Position.timestamp index
+
+Revision ID: c2f8a6d1e9b4
+Revises: 7f3e1a9c5b20
+Create Date: 2026-10-18 21:12:45.306118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2f8a6d1e9b4'
+down_revision = '7f3e1a9c5b20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the active position is found by Flight.last_seen now, and every other
+    # query on positions uses ix_position_flight_id_timestamp. an earlier
+    # version of the last_seen migration dropped the index already.
+    op.execute('DROP INDEX IF EXISTS ix_position_timestamp')
+
+
+def downgrade():
+    op.create_index(op.f('ix_position_timestamp'), 'position', ['timestamp'],
+                    unique=False)
@@ -0,0 +1,36 @@
+"""Add PurgeJob table
+
+Revision ID: d7b3e9f1a6c8
+Revises: c2f8a6d1e9b4
+Create Date: 2026-10-18 18:41:12.804517
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7b3e9f1a6c8'
+down_revision = 'c2f8a6d1e9b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('purge_job',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('flight_ids', sa.Text(), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=True),
+    sa.Column('deleted', sa.Integer(), nullable=False),
+    sa.Column('flights', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('owner', sa.String(length=32), nullable=True),
+    sa.Column('heartbeat', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.Column('error', sa.UnicodeText(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('purge_job')
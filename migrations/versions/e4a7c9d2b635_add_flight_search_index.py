@@ -0,0 +1,70 @@
+"""Add full-text search index of PIREP logs and comments
+
+Revision ID: e4a7c9d2b635
+Revises: 9b2d4f6e8a13
+Create Date: 2026-10-18 19:12:27.840461
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a7c9d2b635'
+down_revision = '9b2d4f6e8a13'
+branch_labels = None
+depends_on = None
+
+
+def has_fts5(bind):
+    return any(row[0] == 'ENABLE_FTS5'
+               for row in bind.execute('PRAGMA compile_options'))
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.execute(
+            "CREATE INDEX ix_flight_search ON flight USING gin "
+            "(to_tsvector('english'::regconfig, coalesce(log, '') || ' ' || "
+            "coalesce(comments, '')))"
+        )
+    elif bind.dialect.name == 'sqlite' and has_fts5(bind):
+        op.execute(
+            "CREATE VIRTUAL TABLE flight_search USING fts5(log, comments, "
+            "content='flight', content_rowid='id', "
+            "tokenize='porter unicode61')"
+        )
+        op.execute(
+            "CREATE TRIGGER flight_search_insert AFTER INSERT ON flight "
+            "BEGIN "
+            "INSERT INTO flight_search(rowid, log, comments) "
+            "VALUES (new.id, new.log, new.comments); END"
+        )
+        op.execute(
+            "CREATE TRIGGER flight_search_delete AFTER DELETE ON flight "
+            "BEGIN "
+            "INSERT INTO flight_search(flight_search, rowid, log, comments) "
+            "VALUES ('delete', old.id, old.log, old.comments); END"
+        )
+        op.execute(
+            "CREATE TRIGGER flight_search_update AFTER UPDATE OF log, "
+            "comments ON flight BEGIN "
+            "INSERT INTO flight_search(flight_search, rowid, log, comments) "
+            "VALUES ('delete', old.id, old.log, old.comments); "
+            "INSERT INTO flight_search(rowid, log, comments) "
+            "VALUES (new.id, new.log, new.comments); END"
+        )
+        op.execute(
+            "INSERT INTO flight_search(flight_search) VALUES ('rebuild')"
+        )
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.execute('DROP INDEX IF EXISTS ix_flight_search')
+    elif bind.dialect.name == 'sqlite':
+        op.execute('DROP TRIGGER IF EXISTS flight_search_insert')
+        op.execute('DROP TRIGGER IF EXISTS flight_search_delete')
+        op.execute('DROP TRIGGER IF EXISTS flight_search_update')
+        op.execute('DROP TABLE IF EXISTS flight_search')
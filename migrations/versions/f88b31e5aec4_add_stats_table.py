@@ -0,0 +1,36 @@
+"""Add Stats table
+
+Revision ID: f88b31e5aec4
+Revises: f5a3285d6354
+Create Date: 2026-10-18 11:41:09.625817
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f88b31e5aec4'
+down_revision = 'f5a3285d6354'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stats',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('total_flights', sa.Integer(), nullable=False),
+    sa.Column('total_duration', sa.Integer(), nullable=False),
+    sa.Column('total_landing_rate', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute(
+        'INSERT INTO stats (id, total_flights, total_duration, '
+        'total_landing_rate) SELECT 1, count(id), coalesce(sum(duration), 0), '
+        'coalesce(sum(landing_rate), 0) FROM flight WHERE landing_rate IS NOT '
+        'NULL AND log IS NOT NULL'
+    )
+
+
+def downgrade():
+    op.drop_table('stats')
@@ -2,26 +2,67 @@
 
 __version__ = 'git'
 
+import atexit
+import glob
+import gzip
+import hashlib
+import heapq
+import json
+import math
 import os
+import random
 import re
 import requests
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import zlib
+from array import array
+from collections import Counter, OrderedDict, deque, namedtuple
+from itertools import accumulate
 from csv import DictReader
-from datetime import datetime, timedelta
-from flask import Flask, Markup, abort, flash, jsonify, make_response, \
-     render_template, request, send_from_directory, url_for
-from flask_admin import Admin, AdminIndexView as BaseAdminIndexView
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Markup, Response, abort, flash, g, \
+     has_request_context, jsonify, make_response, redirect, render_template, \
+     request, send_from_directory, stream_with_context, url_for
+from flask_admin import Admin, AdminIndexView as BaseAdminIndexView, \
+     BaseView, expose
 from flask_admin.actions import action
 from flask_admin.contrib.sqla import ModelView as BaseModelView
 from flask_admin.form.upload import FileUploadField
-from flask_migrate import Migrate, MigrateCommand
+from flask_migrate import Migrate, MigrateCommand, upgrade
 from flask_script import Manager
 from flask_sqlalchemy import SQLAlchemy
-from io import StringIO
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DataError, IntegrityError
 from sqlalchemy.event import listens_for
+from sqlalchemy.orm import object_session
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 re_log = re.compile(r'(.)(\[[0-9]{2}:[0-9]{2}:[0-9]{2}\])')
 re_clean_airport = re.compile(
     r'(airport|air base|air force base|international)', re.I)
+re_explainable = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.I)
+re_full_scan = re.compile(r'^(SCAN|USE TEMP B-TREE)\b')
+re_allowed_scan = re.compile(
+    r'^SCAN (TABLE )?flight USING (COVERING )?INDEX '
+    r'(ix_flight_bids|ix_flight_complete)\b')
+re_search_term = re.compile(r'\w+')
 
 cwd = os.path.dirname(os.path.abspath(__file__))
 
@@ -46,9 +87,69 @@ app.config.update(
     PASSWORD='password',
     ENABLE_CHAT=False,
 
+    # position ingestion settings
+    POSITION_WRITE_BEHIND=False,  # needs a single worker process
+    POSITION_WRITER_LOCK=os.path.join(cwd, 'position-writer.lock'),
+    POSITION_BATCH_SIZE=100,
+    POSITION_BATCH_DELAY=5.0,  # seconds
+    POSITION_QUEUE_SIZE=1000,  # reports are refused beyond
+    POSITION_DEDUP=True,
+    POSITION_DEDUP_CACHE_SIZE=100,
+    LAST_SEEN_INTERVAL=15,  # seconds
+
+    # flight track settings
+    TRACK_ZOOM=10,  # zoom level used to simplify tracks shown on maps
+    TRACK_CACHE_SIZE=64,
+    CHART_POINTS=500,  # altitude and ground speed points shown on charts
+
+    # public website settings
+    FLIGHTS_PER_PAGE=20,
+    SEARCH_RESULTS_PER_PAGE=20,
+
+    # smartCARS session settings
+    SESSION_LIFETIME=7 * 24 * 60 * 60,  # seconds
+    SESSION_CACHE_SIZE=64,
+    SESSION_CACHE_TTL=300,  # seconds
+    SESSION_EXPIRY_INTERVAL=60 * 60,  # seconds
+
+    # metrics settings
+    METRICS_PUBLIC=False,  # if False, /metrics requires admin credentials
+    SQL_PROFILING=False,  # capture slow statements and their plans
+    SQL_SLOW_THRESHOLD=0.1,  # in seconds
+    SQL_QUERY_LIMIT=20,  # flag requests issuing more statements than this
+    SQL_PROFILE_SIZE=100,  # slow statements and requests kept for review
+
+    # live tracking settings
+    LIVE_CACHE='memory',  # or 'file', to share it between worker processes
+    LIVE_CACHE_PATH=os.path.join(cwd, 'live.json'),
+    LIVE_FLIGHTS_CACHE_PATH=os.path.join(cwd, 'live-flights.json'),
+    LIVE_CACHE_RECHECK=15,  # seconds
+    LIVE_NEAR_DISTANCE=50,  # show the nearest airport within, in nm
+    LIVE_STREAM_KEEPALIVE=15,  # seconds
+    LIVE_STREAM_TIMEOUT=600,  # seconds, clients reconnect afterwards
+
     # admin settings
     OFP_PATH=os.path.join(cwd, 'ofp'),
 
+    # flight metrics settings
+    CRUISE_PHASE=5,  # smartCARS phase used for the average cruise speed
+
+    # diversion detection settings
+    DIVERSION_GROUND_SPEED=40,  # on the ground below, in knots
+    DIVERSION_DISTANCE=5,  # max distance to the airport, in nm
+
+    # completed flight settings
+    GEOJSON_PATH=os.path.join(cwd, 'geojson'),
+    GEOJSON_MAX_AGE=24 * 60 * 60,  # seconds
+    POSITION_ARCHIVE=False,  # pack positions into Flight.track after pirep
+
+    # retention settings
+    PURGE_CHUNK_SIZE=5000,  # positions deleted per transaction
+    PURGE_JOBS=20,  # finished purge jobs kept for the admin
+    PURGE_JOB_TIMEOUT=60,  # seconds, resume jobs without progress since
+    RETENTION_BID_DAYS=30,  # purge positions of bids not flown since
+    RETENTION_COMPLETED_DAYS=None,  # keep only a summary of older flights
+
     # public website settings
     SITE_TITLE='myACARS',
     SITE_TAGLINE='A personal Virtual Airline using smartCARS',
@@ -62,8 +163,48 @@ migrate = Migrate(app, db)
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
-if not os.path.isdir(app.config['OFP_PATH']):
-    os.makedirs(app.config['OFP_PATH'])
+for path in (app.config['OFP_PATH'], app.config['GEOJSON_PATH']):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+class LRUCache:
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires = self.data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires < time.monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        with self.lock:
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
 
 
 class BasicAuthMixin:
@@ -101,19 +242,83 @@ class SessionView(ModelView):
 
 class Session(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    sessionid = db.Column(db.String(64))
+    sessionid = db.Column(db.String(64), index=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
+    last_expiry = 0
+
+    @classmethod
+    def expire(cls):
+        cutoff = datetime.utcnow() - timedelta(
+            seconds=app.config['SESSION_LIFETIME'])
+        rv = cls.query.filter(cls.timestamp < cutoff).delete(
+            synchronize_session=False)
+        db.session.commit()
+        session_cache.clear()
+        cls.last_expiry = time.monotonic()
+        return rv
+
+    @classmethod
+    def expire_periodically(cls):
+        if time.monotonic() - cls.last_expiry >= \
+           app.config['SESSION_EXPIRY_INTERVAL']:
+            cls.expire()
+
+    @classmethod
+    def is_valid(cls, sessionid):
+        if not sessionid:
+            return False
+        timestamp = session_cache.get(sessionid)
+        if timestamp is None:
+            sess = cls.query.filter_by(sessionid=sessionid).first()
+            if sess is None:
+                return False
+            timestamp = sess.timestamp
+            session_cache.set(sessionid, timestamp)
+        return timestamp >= datetime.utcnow() - timedelta(
+            seconds=app.config['SESSION_LIFETIME'])
+
+
+session_cache = LRUCache(app.config['SESSION_CACHE_SIZE'],
+                         app.config['SESSION_CACHE_TTL'])
+
+
+@listens_for(Session, 'after_delete')
+def del_cached_session(mapper, connection, target):
+    session_cache.pop(target.sessionid)
+
 
 class AirportView(ModelView):
     column_searchable_list = ['icao', 'name']
     column_filters = ['icao', 'name', 'country']
     form_excluded_columns = ['flights_from', 'flights_to']
+    list_template = 'admin/airport_list.html'
+
+    @expose('/nearest/')
+    def nearest_view(self):
+        query = request.args.get('q', '').strip()
+        count = min(max(request.args.get('count', 10, type=int), 1), 100)
+        origin = results = None
+        if query:
+            try:
+                lat, lon = [float(i) for i in query.split(',')]
+                origin = '%.4f, %.4f' % (lat, lon)
+            except ValueError:
+                apt = Airport.query.filter_by(icao=query.upper()).first()
+                if apt is None:
+                    flash('Airport not found: %s' % query, 'error')
+                else:
+                    lat, lon = apt.latitude, apt.longitude
+                    origin = str(apt)
+            if origin is not None:
+                results = nearest_airports(lat, lon, count)
+        return self.render('admin/airport_nearest.html', query=query,
+                           count=count, origin=origin, results=results)
 
 
 class Airport(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    icao = db.Column(db.String(4), nullable=False)
+    icao = db.Column(db.String(4), nullable=False, index=True)
     name = db.Column(db.Unicode(200), nullable=False)
     latitude = db.Column(db.Float, nullable=False)
     longitude = db.Column(db.Float, nullable=False)
@@ -145,11 +350,345 @@ class Aircraft(db.Model):
         return '%s - %s (%s)' % (self.registration, self.name, self.icao)
 
 
+class CachedResponse:
+
+    def __init__(self, data=None, data_gzip=None, etag=None):
+        # with a known etag, the payload is only needed when the client
+        # doesn't have it already, and is only decompressed if it doesn't
+        # accept gzip
+        if data_gzip is None and data is not None:
+            data_gzip = gzip.compress(data)
+        if etag is None:
+            etag = hashlib.sha1(
+                data if data is not None else gzip.decompress(data_gzip)
+            ).hexdigest()
+        self._data = data
+        self.data_gzip = data_gzip
+        self.etag = etag
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = gzip.decompress(self.data_gzip)
+        return self._data
+
+    def send(self, mimetype='text/html', max_age=None):
+        if request.if_none_match.contains(self.etag):
+            rv = make_response('', 304)
+        elif request.accept_encodings['gzip']:
+            rv = make_response(self.data_gzip)
+            rv.headers['Content-Encoding'] = 'gzip'
+        else:
+            rv = make_response(self.data)
+        rv.mimetype = mimetype
+        rv.set_etag(self.etag)
+        rv.vary.add('Accept-Encoding')
+        if max_age is not None:
+            rv.cache_control.public = True
+            rv.cache_control.max_age = max_age
+        return rv
+
+
+class CacheVersion(db.Model):
+    name = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+# cached responses are tagged with the version of the data they were built
+# from. versions are bumped in the same transaction as the changes, so every
+# worker process notices them.
+response_cache = {}
+response_versions = {
+    'getairports': 'airports',
+    'airport_tree': 'airports',
+    'getaircraft': 'aircraft',
+}
+
+
+def get_cache_version(name):
+    # read once per request, e.g. by the nearest_airports lookups of a page
+    if has_request_context() and name in g.setdefault('cache_versions', {}):
+        return g.cache_versions[name]
+    version = db.session.query(CacheVersion.version).filter(
+        CacheVersion.name == name).scalar() or 0
+    if has_request_context():
+        g.cache_versions[name] = version
+    return version
+
+
+def bump_cache_version(connection, name):
+    if has_request_context():
+        g.setdefault('cache_versions', {}).pop(name, None)
+    table = CacheVersion.__table__
+    if connection.execute(table.update().where(table.c.name == name).values(
+            version=table.c.version + 1)).rowcount == 0:
+        connection.execute(table.insert().values(name=name, version=1))
+
+
+def get_cached(key, func):
+    # the version is read before the data, so a response built while the
+    # data changes is tagged with the old version and built again later
+    version = get_cache_version(response_versions[key])
+    entry = response_cache.get(key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    rv = func()
+    response_cache[key] = (version, rv)
+    return rv
+
+
+@listens_for(CacheVersion.__table__, 'after_create')
+def create_cache_versions(target, connection, **kw):
+    for name in sorted(set(response_versions.values())):
+        connection.execute(target.insert().values(name=name, version=0))
+
+
+@listens_for(Airport, 'after_insert')
+@listens_for(Airport, 'after_update')
+@listens_for(Airport, 'after_delete')
+def airport_changed(mapper, connection, target):
+    bump_cache_version(connection, 'airports')
+
+
+@listens_for(Aircraft, 'after_insert')
+@listens_for(Aircraft, 'after_update')
+@listens_for(Aircraft, 'after_delete')
+def aircraft_changed(mapper, connection, target):
+    bump_cache_version(connection, 'aircraft')
+
+
+class KDTree:
+
+    def __init__(self, points, items):
+        # nodes are stored in flat lists, children of node i are found
+        # through self.left[i] and self.right[i] (-1 for none)
+        self.points = []
+        self.items = []
+        self.axes = []
+        self.left = []
+        self.right = []
+        self.root = self.build(list(zip(points, items)), 0)
+
+    def build(self, nodes, depth):
+        if not nodes:
+            return -1
+        axis = depth % 3
+        nodes.sort(key=lambda i: i[0][axis])
+        median = len(nodes) // 2
+        i = len(self.points)
+        self.points.append(nodes[median][0])
+        self.items.append(nodes[median][1])
+        self.axes.append(axis)
+        self.left.append(-1)
+        self.right.append(-1)
+        self.left[i] = self.build(nodes[:median], depth + 1)
+        self.right[i] = self.build(nodes[median + 1:], depth + 1)
+        return i
+
+    def nearest(self, point, count=1, max_distance=None):
+        # returns up to count (distance, item) tuples, closest first. points
+        # are (x, y, z) tuples.
+        best = []  # heap of (-squared distance, node)
+        limit = math.inf if max_distance is None else max_distance ** 2
+        px, py, pz = point
+        points, axes, left, right = self.points, self.axes, self.left, \
+            self.right
+        stack = [self.root]
+        while stack:
+            i = stack.pop()
+            if i == -1:
+                continue
+            x, y, z = node = points[i]
+            dist = (x - px) ** 2 + (y - py) ** 2 + (z - pz) ** 2
+            if dist <= limit:
+                if len(best) < count:
+                    heapq.heappush(best, (-dist, i))
+                elif dist < -best[0][0]:
+                    heapq.heapreplace(best, (-dist, i))
+                if len(best) == count:
+                    limit = -best[0][0]
+            diff = point[axes[i]] - node[axes[i]]
+            if diff < 0:
+                near, far = left[i], right[i]
+            else:
+                near, far = right[i], left[i]
+            # the far side is visited last, and only if it can hold a
+            # closer point
+            if diff * diff <= limit:
+                stack.append(far)
+            stack.append(near)
+        return [(math.sqrt(-d), self.items[i])
+                for d, i in sorted(best, reverse=True)]
+
+
+AirportItem = namedtuple('AirportItem', ['id', 'icao', 'name', 'latitude',
+                                         'longitude', 'country'])
+
+
+def to_unit_sphere(lat, lon):
+    lat, lon = math.radians(lat), math.radians(lon)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon),
+            math.sin(lat))
+
+
+def build_airport_tree():
+    airports = [AirportItem(*i) for i in db.session.query(
+        Airport.id, Airport.icao, Airport.name, Airport.latitude,
+        Airport.longitude, Airport.country)]
+    return KDTree([to_unit_sphere(i.latitude, i.longitude)
+                   for i in airports], airports)
+
+
+def get_airport_tree():
+    # cached like the smartCARS responses, see get_cached
+    return get_cached('airport_tree', build_airport_tree)
+
+
+def nearest_airports(lat, lon, count=1, max_distance=None):
+    # distances are in nautical miles. chord lengths between points on the
+    # unit sphere grow with the great circle distance, so the tree can use
+    # plain euclidean distances.
+    if max_distance is not None:
+        max_distance = 2 * math.sin(min(max_distance / 3440.065, math.pi) / 2)
+    return [
+        (2 * 3440.065 * math.asin(min(1, chord / 2)), apt)
+        for chord, apt in get_airport_tree().nearest(
+            to_unit_sphere(lat, lon), count, max_distance)
+    ]
+
+
+TrackPoint = namedtuple('TrackPoint', ['latitude', 'longitude', 'altitude',
+                                       'heading', 'ground_speed', 'phase',
+                                       'timestamp'])
+
+# version, number of points, timestamp of the first point (epoch)
+track_header = struct.Struct('<BId')
+track_columns = [
+    ('latitude', 'd'),
+    ('longitude', 'd'),
+    ('altitude', 'i'),
+    ('heading', 'i'),
+    ('ground_speed', 'i'),
+    ('phase', 'i'),  # -1 for unknown phase
+    ('timestamp', 'q'),  # microseconds since previous point
+]
+track_fields = [name for name, typecode in track_columns]
+
+
+def pack_track(positions):
+    base = positions[0].timestamp
+    prev = base
+    deltas = []
+    for pos in positions:
+        delta = pos.timestamp - prev
+        deltas.append((delta.days * 86400 + delta.seconds) * 1000000 +
+                      delta.microseconds)
+        prev = pos.timestamp
+    values = {
+        'latitude': [i.latitude for i in positions],
+        'longitude': [i.longitude for i in positions],
+        'altitude': [i.altitude for i in positions],
+        'heading': [i.heading for i in positions],
+        'ground_speed': [i.ground_speed for i in positions],
+        'phase': [-1 if i.phase is None else i.phase for i in positions],
+        'timestamp': deltas,
+    }
+    rv = [track_header.pack(1, len(positions), to_epoch(base))]
+    for name, typecode in track_columns:
+        col = array(typecode, values[name])
+        if sys.byteorder == 'big':
+            col.byteswap()
+        rv.append(col.tobytes())
+    return zlib.compress(b''.join(rv))
+
+
+def unpack_track_columns(data):
+    data = zlib.decompress(data)
+    version, count, base = track_header.unpack_from(data)
+    if version != 1:
+        raise ValueError('Unsupported track version: %d' % version)
+    offset = track_header.size
+    rv = {}
+    for name, typecode in track_columns:
+        col = array(typecode)
+        size = col.itemsize * count
+        col.frombytes(data[offset:offset + size])
+        if sys.byteorder == 'big':
+            col.byteswap()
+        rv[name] = col
+        offset += size
+
+    # timestamps are returned as epoch seconds
+    timestamps = array('d')
+    ts = 0
+    for delta in rv['timestamp']:
+        ts += delta
+        timestamps.append(base + ts / 1000000)
+    rv['timestamp'] = timestamps
+    return rv
+
+
+def unpack_track(data):
+    cols = unpack_track_columns(data)
+    cols['phase'] = [None if i == -1 else i for i in cols['phase']]
+    cols['timestamp'] = [datetime.utcfromtimestamp(0) + timedelta(seconds=i)
+                         for i in cols['timestamp']]
+    return [TrackPoint(*i) for i in zip(*[cols[name]
+                                          for name in track_fields])]
+
+
+def filter_positions(positions):
+    prev = None
+    rv = []
+    for pos in positions:
+        if prev is not None:
+            if not (prev.altitude == pos.altitude and
+                    prev.latitude == pos.latitude and
+                    prev.longitude == pos.longitude and
+                    prev.heading == pos.heading and
+                    prev.ground_speed != 0 and
+                    prev.phase == pos.phase):
+                rv.append(pos)
+        prev = pos
+    return rv
+
+
+def filter_track_columns(cols):
+    # same as filter_positions, with numpy arrays
+    cols = {k: numpy.asarray(v) for k, v in cols.items()}
+    mask = numpy.zeros(len(cols['altitude']), dtype=bool)
+    if len(mask) > 1:
+        eq = {k: v[1:] == v[:-1] for k, v in cols.items()
+              if k in ('altitude', 'latitude', 'longitude', 'heading',
+                       'phase')}
+        mask[1:] = ~(eq['altitude'] & eq['latitude'] & eq['longitude'] &
+                     eq['heading'] & (cols['ground_speed'][:-1] != 0) &
+                     eq['phase'])
+    return {k: v[mask] for k, v in cols.items()}
+
+
 class FlightView(ModelView):
-    column_exclude_list = ['log', 'ofp', 'comments']
+    column_list = ['id', 'airline_icao', 'flight_number', 'origin',
+                   'destination', 'route', 'flight_level', 'aircraft',
+                   'duration', 'landing_rate', 'started_at', 'diversion',
+                   'metrics.distance', 'metrics.max_altitude',
+                   'metrics.block_off', 'metrics.block_on']
+    column_labels = {
+        'metrics.distance': 'Distance (nm)',
+        'metrics.max_altitude': 'Max Altitude',
+        'metrics.block_off': 'Block Off',
+        'metrics.block_on': 'Block On',
+    }
+    column_formatters = {
+        'metrics.distance': lambda v, c, m, p:
+        None if m.metrics is None else round(m.metrics.distance, 1),
+    }
+    column_select_related_list = ['metrics']
     column_searchable_list = ['airline_icao', 'flight_number']
+    list_template = 'admin/flight_list.html'
     column_filters = ['airline_icao', 'flight_number']
-    form_excluded_columns = ['duration', 'landing_rate', 'log', 'positions']
+    form_excluded_columns = ['duration', 'landing_rate', 'log', 'positions',
+                             'track', 'metrics', 'last_seen']
     form_overrides = {'ofp': FileUploadField}
     form_args = {
         'ofp': {
@@ -163,6 +702,7 @@ class FlightView(ModelView):
             'Are you sure you want to clean positions for selected flights?')
     def action_clean_positions(self, ids):
         try:
+            bids = []
             for id in ids:
                 flt = Flight.query.get(int(id))
                 if flt is None:
@@ -171,15 +711,32 @@ class FlightView(ModelView):
                     flash("Can't clean positions for completed flight: %s" %
                           id, 'error')
                     continue
-                for pos in flt.positions:
-                    db.session.delete(pos)
-                db.session.commit()
-                flash('Cleaned positions for flight: %s' % id)
+                bids.append(flt.id)
+            if bids:
+                start_purge_job(PurgeJob.create(bids))
+                flash(Markup('Cleaning positions for flights: %s. '
+                             '<a href="%s">Show progress</a>' % (
+                                 ', '.join(map(str, bids)),
+                                 url_for('purge.index'))))
         except Exception as ex:
             if not self.handle_view_exception(ex):
                 raise
             flash('Failed to clean positions. %s' % ex, 'error')
 
+    @expose('/search/')
+    def search_view(self):
+        query = request.args.get('q', '').strip()
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = app.config['SEARCH_RESULTS_PER_PAGE']
+        results = None
+        if query:
+            results = search_flights(query, per_page + 1,
+                                     (page - 1) * per_page)
+        return self.render('admin/flight_search.html', query=query,
+                           page=page, results=(results or [])[:per_page],
+                           searched=results is not None,
+                           has_next=len(results or []) > per_page)
+
 
 class Flight(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -204,6 +761,19 @@ class Flight(db.Model):
     log = db.Column(db.UnicodeText, nullable=True)
     comments = db.Column(db.UnicodeText, nullable=True)
     ofp = db.Column(db.String(256), nullable=True)
+    track = db.deferred(db.Column(db.LargeBinary, nullable=True))
+    started_at = db.Column(db.DateTime, nullable=True)
+    diversion_id = db.Column(db.Integer, db.ForeignKey(Airport.id),
+                             nullable=True)
+    diversion = db.relationship('Airport', foreign_keys=[diversion_id])
+    last_seen = db.Column(db.DateTime, nullable=True, index=True)
+
+    __table_args__ = (
+        db.Index('ix_flight_bids', id, sqlite_where=log.is_(None),
+                 postgresql_where=log.is_(None)),
+        db.Index('ix_flight_complete', id, sqlite_where=log.isnot(None),
+                 postgresql_where=log.isnot(None)),
+    )
 
     @classmethod
     def complete_flights(cls):
@@ -217,11 +787,20 @@ class Flight(db.Model):
         total_minutes = self.duration % 60
         return '%02d:%02d:00' % (total_hours, total_minutes)
 
+    @property
+    def track_points(self):
+        if self.track is not None:
+            return unpack_track(self.track)
+        return self.positions
+
     @property
     def start(self):
-        if len(self.positions) == 0:
+        if self.started_at is not None:
+            return self.started_at
+        points = self.track_points
+        if len(points) == 0:
             return None
-        return self.positions[0].timestamp
+        return points[0].timestamp
 
     @property
     def html_title(self):
@@ -238,19 +817,67 @@ class Flight(db.Model):
 
     @property
     def positions_filtered(self):
-        prev = None
-        positions = []
-        for pos in self.positions:
-            if prev is not None:
-                if not (prev.altitude == pos.altitude and
-                        prev.latitude == pos.latitude and
-                        prev.longitude == pos.longitude and
-                        prev.heading == pos.heading and
-                        prev.ground_speed != 0 and
-                        prev.phase == pos.phase):
-                    positions.append(pos)
-            prev = pos
-        return positions
+        return filter_positions(self.track_points)
+
+    def get_track_columns(self, names):
+        # phase is -1 when unknown and timestamps are epoch seconds, like
+        # unpack_track_columns
+        if self.track is not None:
+            cols = unpack_track_columns(self.track)
+            return {i: cols[i] for i in names}
+        pos = Position.__table__
+        rows = db.session.execute(
+            db.select([db.func.coalesce(pos.c.phase, -1) if i == 'phase'
+                       else pos.c[i] for i in names])
+            .where(pos.c.flight_id == self.id)
+            .order_by(pos.c.timestamp)
+        ).fetchall()
+        rv = {i: list(col) for i, col in zip(names, zip(*rows))}
+        if 'timestamp' in rv:
+            rv['timestamp'] = [to_epoch(i) for i in rv['timestamp']]
+        return {i: rv.get(i, []) for i in names}
+
+    def check_diversion(self, lat, lon, ground_speed):
+        # the airport where the aircraft is on the ground tells where the
+        # flight actually went. near the origin or the destination there is
+        # no diversion, even if another airport is closer to the aircraft.
+        if ground_speed >= app.config['DIVERSION_GROUND_SPEED']:
+            return
+        max_distance = app.config['DIVERSION_DISTANCE']
+        if haversine(lat, lon, self.origin.latitude,
+                     self.origin.longitude) <= max_distance:
+            return
+        if haversine(lat, lon, self.destination.latitude,
+                     self.destination.longitude) <= max_distance:
+            apt = None
+        else:
+            near = nearest_airports(lat, lon, max_distance=max_distance)
+            if not near:
+                return
+            apt = near[0][1]
+        diversion_id = None if apt is None else apt.id
+        if diversion_id != self.diversion_id:
+            self.diversion_id = diversion_id
+            if diversion_id is not None:
+                app.logger.info('Flight %d diverted to %s', self.id, apt.icao)
+
+    def archive(self, summary=False):
+        if self.track is not None or len(self.positions) == 0:
+            return False
+        if self.started_at is None:
+            self.started_at = self.positions[0].timestamp
+        positions = self.positions
+        if summary:
+            cols = {i: [getattr(pos, i) for pos in positions]
+                    for i in ('latitude', 'longitude', 'altitude',
+                              'ground_speed')}
+            cols['timestamp'] = [to_epoch(i.timestamp) for i in positions]
+            positions = [positions[i] for i in summarize_track(cols)]
+        self.track = pack_track(positions)
+        Position.query.filter_by(flight_id=self.id).delete(
+            synchronize_session=False)
+        db.session.expire(self, ['positions'])
+        return True
 
     def __str__(self):
         return '%s -> %s' % (self.origin, self.destination)
@@ -265,6 +892,247 @@ def del_ofp(mapper, connection, target):
             pass
 
 
+def remove_geojson(flight_id):
+    # etags go first, so that no client is told that an artifact being
+    # removed is still current
+    paths = glob.glob(os.path.join(app.config['GEOJSON_PATH'],
+                                   '%d-*.json.gz*' % flight_id))
+    for path in sorted(paths, key=lambda i: not i.endswith('.etag')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+@listens_for(Flight, 'after_update')
+@listens_for(Flight, 'after_delete')
+def del_geojson(mapper, connection, target):
+    # the artifacts are removed after the commit, so that a concurrent
+    # request can't build them again from old data
+    sess = object_session(target)
+    if sess is None:
+        remove_geojson(target.id)
+        return
+    sess.info.setdefault('stale_geojson', set()).add(target.id)
+
+
+@listens_for(db.session, 'after_commit')
+def clear_stale_geojson(session):
+    for flight_id in session.info.pop('stale_geojson', ()):
+        remove_geojson(flight_id)
+
+
+@listens_for(db.session, 'after_soft_rollback')
+def discard_stale_geojson(session, previous_transaction):
+    session.info.pop('stale_geojson', None)
+
+
+# PIREP logs and comments are indexed by a FTS5 table on SQLite and by a GIN
+# expression index on PostgreSQL. the FTS5 table reads the text from the
+# flight table, and triggers keep it in sync with every change.
+search_config = 'english'
+search_ddl = {
+    'sqlite': [
+        "CREATE VIRTUAL TABLE flight_search USING fts5(log, comments, "
+        "content='flight', content_rowid='id', "
+        "tokenize='porter unicode61')",
+        "CREATE TRIGGER flight_search_insert AFTER INSERT ON flight BEGIN "
+        "INSERT INTO flight_search(rowid, log, comments) "
+        "VALUES (new.id, new.log, new.comments); END",
+        "CREATE TRIGGER flight_search_delete AFTER DELETE ON flight BEGIN "
+        "INSERT INTO flight_search(flight_search, rowid, log, comments) "
+        "VALUES ('delete', old.id, old.log, old.comments); END",
+        "CREATE TRIGGER flight_search_update AFTER UPDATE OF log, comments "
+        "ON flight BEGIN "
+        "INSERT INTO flight_search(flight_search, rowid, log, comments) "
+        "VALUES ('delete', old.id, old.log, old.comments); "
+        "INSERT INTO flight_search(rowid, log, comments) "
+        "VALUES (new.id, new.log, new.comments); END",
+    ],
+    'postgresql': [
+        "CREATE INDEX ix_flight_search ON flight USING gin "
+        "(to_tsvector('%s'::regconfig, coalesce(log, '') || ' ' || "
+        "coalesce(comments, '')))" % search_config,
+    ],
+}
+
+
+def has_fts5(connection):
+    return any(row[0] == 'ENABLE_FTS5'
+               for row in connection.execute('PRAGMA compile_options'))
+
+
+@listens_for(Flight.__table__, 'after_create')
+def create_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite' and not has_fts5(connection):
+        return
+    for statement in search_ddl.get(connection.dialect.name, []):
+        connection.execute(statement)
+
+
+@listens_for(Flight.__table__, 'before_drop')
+def drop_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute('DROP TABLE IF EXISTS flight_search')
+
+
+def get_search_backend(connection):
+    if connection.dialect.name == 'postgresql':
+        return 'postgresql'
+    if connection.dialect.name == 'sqlite' and connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND "
+            "name = 'flight_search'").first() is not None:
+        return 'sqlite'
+    return None
+
+
+def format_snippet(text):
+    # highlights are delimited by control characters, so that the text can
+    # be escaped
+    if text is None:
+        return None
+    return Markup.escape(' '.join(text.split())) \
+        .replace('\x02', Markup('<mark>')) \
+        .replace('\x03', Markup('</mark>'))
+
+
+SearchResult = namedtuple('SearchResult', ['flight', 'rank', 'snippet'])
+
+
+def search_flights(query, limit, offset=0, complete=False):
+    # flights whose log or comments contain all the words of the query, best
+    # matches first
+    terms = re_search_term.findall(query)
+    if not terms:
+        return []
+    conn = db.session.connection()
+    backend = get_search_backend(conn)
+    if backend == 'sqlite':
+        rows = conn.execute(db.text(
+            "SELECT flight_search.rowid, -flight_search.rank, "
+            "snippet(flight_search, -1, :start, :stop, '...', 24) "
+            "FROM flight_search JOIN flight "
+            "ON flight.id = flight_search.rowid "
+            "WHERE flight_search MATCH :query%s "
+            "ORDER BY flight_search.rank LIMIT :limit OFFSET :offset" % (
+                ' AND flight.log IS NOT NULL' if complete else '')),
+            query=' '.join('"%s"' % i for i in terms), start='\x02',
+            stop='\x03', limit=limit, offset=offset).fetchall()
+    elif backend == 'postgresql':
+        config = db.literal_column("'%s'::regconfig" % search_config)
+        document = db.func.coalesce(Flight.log, '') + ' ' + \
+            db.func.coalesce(Flight.comments, '')
+        tsquery = db.func.plainto_tsquery(config, ' '.join(terms))
+        rank = db.func.ts_rank(db.func.to_tsvector(config, document),
+                               tsquery)
+        qs = db.session.query(
+            Flight.id, rank,
+            db.func.ts_headline(config, document, tsquery,
+                                'StartSel=\x02, StopSel=\x03, MaxWords=24'),
+        ).filter(db.func.to_tsvector(config, document).op('@@')(tsquery))
+        if complete:
+            qs = qs.filter(Flight.log.isnot(None))
+        rows = qs.order_by(rank.desc(), Flight.id.desc()) \
+            .limit(limit).offset(offset).all()
+    else:
+        # no full-text index, scan the text
+        qs = db.session.query(Flight.id, db.null(), db.null())
+        for term in terms:
+            pattern = '%' + term + '%'
+            qs = qs.filter(db.or_(Flight.log.ilike(pattern),
+                                  Flight.comments.ilike(pattern)))
+        if complete:
+            qs = qs.filter(Flight.log.isnot(None))
+        rows = qs.order_by(Flight.id.desc()).limit(limit).offset(offset) \
+            .all()
+
+    flights = {i.id: i for i in Flight.query.filter(
+        Flight.id.in_([row[0] for row in rows])
+    ).options(
+        db.defer(Flight.log),
+        db.defer(Flight.comments),
+        db.joinedload(Flight.origin),
+        db.joinedload(Flight.destination),
+        db.joinedload(Flight.aircraft),
+    )} if rows else {}
+    return [SearchResult(flights[id], rank, format_snippet(snippet))
+            for id, rank, snippet in rows if id in flights]
+
+
+class Stats(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    total_flights = db.Column(db.Integer, nullable=False, default=0)
+    total_duration = db.Column(db.Integer, nullable=False, default=0)
+    total_landing_rate = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def rebuild(cls):
+        result = db.session.query(
+            db.func.count(Flight.id).label('total_flights'),
+            db.func.sum(Flight.landing_rate).label('total_landing_rate'),
+            db.func.sum(Flight.duration).label('total_duration'),
+        ).filter(
+            Flight.landing_rate.isnot(None),
+            Flight.log.isnot(None),
+        ).first()
+        stats = cls.query.get(1)
+        if stats is None:
+            stats = cls(id=1)
+            db.session.add(stats)
+        stats.total_flights = result.total_flights or 0
+        stats.total_duration = result.total_duration or 0
+        stats.total_landing_rate = result.total_landing_rate or 0
+        db.session.commit()
+        return stats
+
+
+def get_stats_delta(connection, id):
+    flt = Flight.__table__
+    row = connection.execute(
+        db.select([flt.c.log.isnot(None), flt.c.landing_rate, flt.c.duration])
+        .where(flt.c.id == id)
+    ).first()
+    if row is None or not row[0] or row[1] is None:
+        return 0, 0, 0
+    return 1, row[2] or 0, row[1]
+
+
+def update_stats(connection, old, new):
+    delta = [n - o for o, n in zip(old, new)]
+    if not any(delta):
+        return
+    stats = Stats.__table__
+    connection.execute(stats.update().where(stats.c.id == 1).values(
+        total_flights=stats.c.total_flights + delta[0],
+        total_duration=stats.c.total_duration + delta[1],
+        total_landing_rate=stats.c.total_landing_rate + delta[2],
+    ))
+
+
+@listens_for(Flight, 'after_insert')
+def stats_flight_inserted(mapper, connection, target):
+    update_stats(connection, (0, 0, 0),
+                 get_stats_delta(connection, target.id))
+
+
+@listens_for(Flight, 'before_update')
+def stats_flight_updated(mapper, connection, target):
+    state = db.inspect(target)
+    if not any(state.attrs[i].history.has_changes()
+               for i in ('log', 'landing_rate', 'duration')):
+        return
+    new = (0, 0, 0)
+    if target.log is not None and target.landing_rate is not None:
+        new = (1, target.duration or 0, target.landing_rate)
+    update_stats(connection, get_stats_delta(connection, target.id), new)
+
+
+@listens_for(Flight, 'before_delete')
+def stats_flight_deleted(mapper, connection, target):
+    update_stats(connection, get_stats_delta(connection, target.id),
+                 (0, 0, 0))
+
+
 class PositionView(ModelView):
     can_create = False
     can_edit = False
@@ -287,12 +1155,857 @@ class Position(db.Model):
     phase = db.Column(db.Integer, nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_position_flight_id_timestamp', flight_id, timestamp),
+    )
+
     @classmethod
     def get_active_position(cls):
+        return cls.active_position_query().first()
+
+    @classmethod
+    def active_position_query(cls):
+        # reports identical to the last position only refresh
+        # Flight.last_seen, so the flight being flown is found by it
         delta = timedelta(seconds=60)
+        flight_id = db.session.query(Flight.id).filter(
+            Flight.last_seen >= datetime.utcnow() - delta
+        ).order_by(Flight.last_seen.desc()).limit(1)
         return cls.query.filter(
-            cls.timestamp >= datetime.utcnow() - delta
-        ).order_by(cls.timestamp.desc()).first()
+            cls.flight_id == flight_id.as_scalar()
+        ).order_by(cls.timestamp.desc()).limit(1)
+
+    @classmethod
+    def get_active_positions(cls):
+        # latest position of every bid reported in the last minute, in a
+        # single query. each bid costs one lookup in the flight_id/timestamp
+        # index, instead of grouping all the positions of the last minute.
+        delta = timedelta(seconds=60)
+        latest = db.aliased(cls)
+        latest_id = db.session.query(latest.id).filter(
+            latest.flight_id == Flight.id
+        ).order_by(latest.timestamp.desc()).limit(1).correlate(Flight)
+        bids = db.session.query(latest_id.as_scalar()).filter(
+            Flight.log.is_(None),
+            Flight.last_seen >= datetime.utcnow() - delta,
+        )
+        return cls.query.join(cls.flight).filter(
+            cls.id.in_(bids.subquery()),
+        ).options(
+            db.contains_eager(cls.flight).joinedload(Flight.origin),
+            db.contains_eager(cls.flight).joinedload(Flight.destination),
+            db.contains_eager(cls.flight).joinedload(Flight.aircraft),
+        )
+
+    def as_dict(self):
+        return {i.name: getattr(self, i.name) for i in self.__table__.columns}
+
+
+class FlightMetrics(db.Model):
+    # running aggregates, updated as positions are reported
+    flight_id = db.Column(db.Integer, db.ForeignKey(Flight.id),
+                          primary_key=True)
+    flight = db.relationship('Flight', backref=db.backref(
+        'metrics', uselist=False, cascade='all, delete-orphan'))
+    positions = db.Column(db.Integer, nullable=False, default=0)
+    distance = db.Column(db.Float, nullable=False, default=0)  # in nm
+    min_altitude = db.Column(db.Integer, nullable=True)
+    max_altitude = db.Column(db.Integer, nullable=True)
+    max_ground_speed = db.Column(db.Integer, nullable=True)
+    cruise_time = db.Column(db.Float, nullable=False, default=0)  # seconds
+    cruise_distance = db.Column(db.Float, nullable=False, default=0)
+    block_off = db.Column(db.DateTime, nullable=True)
+    block_on = db.Column(db.DateTime, nullable=True)
+    # phase transitions, as a JSON list of [phase, epoch] pairs
+    phases = db.Column(db.UnicodeText, nullable=False, default='[]')
+    last_latitude = db.Column(db.Float, nullable=True)
+    last_longitude = db.Column(db.Float, nullable=True)
+    last_ground_speed = db.Column(db.Integer, nullable=True)
+    last_phase = db.Column(db.Integer, nullable=True)
+    last_timestamp = db.Column(db.DateTime, nullable=True)
+
+    @classmethod
+    def initial_state(cls, flight_id):
+        state = {i.name: None for i in cls.__table__.columns}
+        state.update(flight_id=flight_id, positions=0, distance=0,
+                     cruise_time=0, cruise_distance=0, phases=[])
+        return state
+
+    @staticmethod
+    def accumulate(state, pos, stored=True):
+        # stored is False for a report that only moved the timestamp of the
+        # latest position of the flight
+        timestamp = pos['timestamp']
+        if stored:
+            state['positions'] += 1
+        if state['min_altitude'] is None or \
+                pos['altitude'] < state['min_altitude']:
+            state['min_altitude'] = pos['altitude']
+        if state['max_altitude'] is None or \
+                pos['altitude'] > state['max_altitude']:
+            state['max_altitude'] = pos['altitude']
+        if state['max_ground_speed'] is None or \
+                pos['ground_speed'] > state['max_ground_speed']:
+            state['max_ground_speed'] = pos['ground_speed']
+
+        moving = pos['ground_speed'] > 0
+        if moving:
+            if state['block_off'] is None:
+                state['block_off'] = timestamp
+            state['block_on'] = None
+        elif state['last_ground_speed']:
+            state['block_on'] = timestamp
+
+        if pos['phase'] != state['last_phase'] or not state['phases']:
+            state['phases'].append([pos['phase'], to_epoch(timestamp)])
+
+        # smartCARS reports 0, 0 before the simulator position is known
+        if pos['latitude'] or pos['longitude']:
+            if state['last_latitude'] is not None:
+                distance = haversine(state['last_latitude'],
+                                     state['last_longitude'],
+                                     pos['latitude'], pos['longitude'])
+                state['distance'] += distance
+                cruise = app.config['CRUISE_PHASE']
+                if pos['phase'] == cruise and state['last_phase'] == cruise:
+                    state['cruise_distance'] += distance
+                    state['cruise_time'] += max(
+                        (timestamp - state['last_timestamp']).total_seconds(),
+                        0)
+            state['last_latitude'] = pos['latitude']
+            state['last_longitude'] = pos['longitude']
+
+        state['last_ground_speed'] = pos['ground_speed']
+        state['last_phase'] = pos['phase']
+        state['last_timestamp'] = timestamp
+
+    @staticmethod
+    def summarize(state):
+        phases = state['phases']
+        if isinstance(phases, str):
+            phases = json.loads(phases)
+        phase_times = OrderedDict()
+        end = None
+        if state['last_timestamp'] is not None:
+            end = to_epoch(state['last_timestamp'])
+        for i, (phase, start) in enumerate(phases):
+            stop = phases[i + 1][1] if i + 1 < len(phases) else end
+            key = str(phase)
+            phase_times[key] = phase_times.get(key, 0) + round(stop - start)
+        cruise_ground_speed = None
+        if state['cruise_time']:
+            cruise_ground_speed = round(
+                state['cruise_distance'] / state['cruise_time'] * 3600)
+        return {
+            'distance': round(state['distance'], 1),
+            'min_altitude': state['min_altitude'],
+            'max_altitude': state['max_altitude'],
+            'max_ground_speed': state['max_ground_speed'],
+            'cruise_ground_speed': cruise_ground_speed,
+            'block_off': None if state['block_off'] is None else
+            to_epoch(state['block_off']),
+            'block_on': None if state['block_on'] is None else
+            to_epoch(state['block_on']),
+            'phase_times': phase_times,
+        }
+
+    @property
+    def summary(self):
+        return self.summarize(
+            {i.name: getattr(self, i.name) for i in self.__table__.columns})
+
+
+def update_flight_metrics(connection, positions, stored=None):
+    # positions of one or more flights, in the order they were reported,
+    # and whether each one was stored as a row of its own. returns the new
+    # state of the metrics of each flight.
+    table = FlightMetrics.__table__
+    if stored is None:
+        stored = [True] * len(positions)
+    by_flight = OrderedDict()
+    for pos, added in zip(positions, stored):
+        by_flight.setdefault(pos['flight_id'], []).append((pos, added))
+    rows = {
+        row.flight_id: dict(row) for row in connection.execute(
+            table.select().where(table.c.flight_id.in_(list(by_flight))))
+    }
+    rv = {}
+    for flight_id, items in by_flight.items():
+        state = rows.get(flight_id)
+        if state is None:
+            state = FlightMetrics.initial_state(flight_id)
+        else:
+            state['phases'] = json.loads(state['phases'])
+        for pos, added in items:
+            FlightMetrics.accumulate(state, pos, added)
+        values = dict(state, phases=json.dumps(state['phases']))
+        if flight_id in rows:
+            connection.execute(table.update().where(
+                table.c.flight_id == flight_id), values)
+        else:
+            connection.execute(table.insert(), values)
+        rv[flight_id] = state
+    return rv
+
+
+class PositionWriter:
+
+    retries = 3
+
+    def __init__(self, batch_size, batch_delay, queue_size, lock_path=None):
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.queue_size = queue_size
+        self.lock_path = lock_path
+        self.lock_file = None
+        self.items = deque()
+        self.condition = threading.Condition()
+
+        # reports are only taken from the queue with write_lock held, so
+        # they are written one batch at a time, in the order they came
+        self.write_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def acquire(self):
+        # filepirep only waits for the reports queued by its own process,
+        # so a single process may hold reports back at any time
+        if fcntl is None or self.lock_path is None:
+            return
+        fp = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fp.close()
+            raise RuntimeError('Position reports are queued by another '
+                               'process, POSITION_WRITE_BEHIND needs a '
+                               'single worker process')
+        self.lock_file = fp
+
+    def start(self):
+        with self.lock:
+            if self.lock_file is None:
+                self.acquire()
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run,
+                                               name='position-writer',
+                                               daemon=True)
+                self.thread.start()
+
+    def put(self, item):
+        # raises RuntimeError if the report can't be queued
+        self.start()
+        with self.condition:
+            full = len(self.items) >= self.queue_size
+        if full:
+            # the flusher can't keep up, write the backlog ourselves
+            with self.write_lock:
+                self.write_pending()
+        with self.condition:
+            if len(self.items) >= self.queue_size:
+                raise RuntimeError('Position queue is full')
+            self.items.append(item)
+            self.condition.notify()
+
+    def flush(self):
+        # waits for the batch being written by the flusher thread, if any,
+        # then writes everything that was queued
+        for i in range(self.retries):
+            if i:
+                time.sleep(i)
+            with self.write_lock:
+                if self.write_pending():
+                    return
+        raise RuntimeError('Failed to write %d position reports' %
+                           len(self.items))
+
+    def write_pending(self):
+        # returns False if some reports are left in the queue after a
+        # transient failure
+        while True:
+            with self.condition:
+                batch = [self.items.popleft() for i in range(
+                    min(len(self.items), self.batch_size))]
+            if not batch:
+                return True
+            failed = self.write(batch)
+            if failed:
+                with self.condition:
+                    self.items.extendleft(reversed(failed))
+                return False
+
+    def write(self, batch):
+        # returns the reports that must be written again later
+        try:
+            with db.engine.begin() as conn:
+                write_positions(conn, batch)
+            return []
+        except (DataError, IntegrityError):
+            if len(batch) == 1:
+                app.logger.exception('Dropping invalid position report: %r',
+                                     batch[0][0])
+                return []
+            # only the invalid reports are dropped
+            for i, values in enumerate(batch):
+                failed = self.write([values])
+                if failed:
+                    return failed + batch[i + 1:]
+            return []
+        except Exception:
+            app.logger.exception('Failed to write %d position reports, '
+                                 'retrying later', len(batch))
+            return batch
+
+    def run(self):
+        failures = 0
+        while True:
+            with self.condition:
+                while not self.items:
+                    self.condition.wait()
+                deadline = time.monotonic() + self.batch_delay
+                while len(self.items) < self.batch_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+            with self.write_lock:
+                written = self.write_pending()
+            if written:
+                failures = 0
+            else:
+                failures += 1
+                time.sleep(min(max(self.batch_delay, 1) * failures, 60))
+
+
+last_positions = LRUCache(app.config['POSITION_DEDUP_CACHE_SIZE'])
+
+redundant_fields = ['latitude', 'longitude', 'altitude', 'heading',
+                    'ground_speed', 'phase']
+
+
+def is_redundant(last, values):
+    return all(last[i] == values[i] for i in redundant_fields)
+
+
+def check_position(values):
+    # returns True if the report repeats the last one this process saw for
+    # the flight. it is only a hint: extend_stop only changes a stored row
+    # if the database agrees, so nothing is lost when the reports of a
+    # flight go to several workers or the entry is evicted.
+    if not app.config['POSITION_DEDUP']:
+        return False
+    state = last_positions.get(values['flight_id'])
+    if state is None:
+        state = {'values': None, 'seen': None}
+    redundant = state['values'] is not None and \
+        is_redundant(state['values'], values)
+    state['values'] = values
+    last_positions.set(values['flight_id'], state)
+    return redundant
+
+
+def extend_stop(connection, values):
+    # a run of identical reports is stored as its first and last report.
+    # when the two latest rows of the flight repeat the report, the latest
+    # one takes its timestamp instead of a row being added. returns False
+    # if the report must be inserted.
+    result = connection.execute(extend_stop_statement(values))
+    return result.rowcount == 1
+
+
+def extend_stop_statement(values):
+    pos = Position.__table__
+    latest, second, previous = pos.alias(), pos.alias(), pos.alias()
+
+    def nth_latest(table, n):
+        return db.select([table.c.id]).where(
+            table.c.flight_id == values['flight_id']
+        ).order_by(table.c.timestamp.desc()).limit(1).offset(n).as_scalar()
+
+    def repeats(table):
+        return db.and_(*[table.c[i] == values[i] for i in redundant_fields])
+
+    return pos.update().where(db.and_(
+        pos.c.id == nth_latest(latest, 0),
+        repeats(pos),
+        db.exists().where(db.and_(
+            previous.c.id == nth_latest(second, 1),
+            repeats(previous),
+        )),
+    )).values(timestamp=values['timestamp'])
+
+
+def write_positions(connection, rows):
+    # rows are (values, redundant) pairs, in the order they were reported.
+    # returns the new metrics state of each flight.
+    pending = []
+    stored = []
+    for values, redundant in rows:
+        if redundant:
+            if pending:
+                connection.execute(Position.__table__.insert(), pending)
+                pending = []
+            if extend_stop(connection, values):
+                stored.append(False)
+                continue
+        pending.append(values)
+        stored.append(True)
+    if pending:
+        connection.execute(Position.__table__.insert(), pending)
+    return update_flight_metrics(connection, [i for i, _ in rows], stored)
+
+
+def touch_last_seen(flight_id, timestamp):
+    # plain UPDATE, so mapper events don't invalidate the cached track and
+    # live data on every report
+    state = last_positions.get(flight_id)
+    if state is not None:
+        seen = state['seen']
+        if seen is not None and (timestamp - seen).total_seconds() < \
+                app.config['LAST_SEEN_INTERVAL']:
+            return
+        state['seen'] = timestamp
+    flt = Flight.__table__
+    db.session.execute(flt.update().where(flt.c.id == flight_id)
+                       .values(last_seen=timestamp))
+
+
+position_writer = PositionWriter(app.config['POSITION_BATCH_SIZE'],
+                                 app.config['POSITION_BATCH_DELAY'],
+                                 app.config['POSITION_QUEUE_SIZE'],
+                                 app.config['POSITION_WRITER_LOCK'])
+atexit.register(position_writer.flush)
+
+
+def store_position(values, redundant):
+    # returns the metrics state of the flight, unless the report is written
+    # in the background. raises RuntimeError if it can't be queued.
+    if app.config['POSITION_WRITE_BEHIND']:
+        # metrics are updated when the batch is written
+        position_writer.put((values, redundant))
+        return None
+    metrics = write_positions(db.session.connection(), [(values, redundant)])
+    return metrics[values['flight_id']]
+
+
+class LiveCache:
+
+    def __init__(self):
+        self.entry = None
+
+    def get(self):
+        return self.entry
+
+    def set(self, entry):
+        self.entry = entry
+
+    def clear(self):
+        self.entry = None
+
+
+class FileLiveCache(LiveCache):
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self):
+        try:
+            with open(self.path) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, entry):
+        tmp = '%s.%d' % (self.path, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump(entry, fp)
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+if app.config['LIVE_CACHE'] == 'file':
+    live_cache = FileLiveCache(app.config['LIVE_CACHE_PATH'])
+    live_flights_cache = FileLiveCache(app.config['LIVE_FLIGHTS_CACHE_PATH'])
+else:
+    live_cache = LiveCache()
+    live_flights_cache = LiveCache()
+
+
+class EventBroker:
+
+    def __init__(self, size=100):
+        self.condition = threading.Condition()
+        self.events = deque(maxlen=size)
+        self.seq = 0
+
+    def publish(self, event, data):
+        with self.condition:
+            self.seq += 1
+            self.events.append((self.seq, event, data))
+            self.condition.notify_all()
+
+    def wait(self, seq, timeout):
+        # returns the events published after seq, or None if some of them
+        # were already dropped from the buffer.
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq > seq, timeout)
+            if self.seq == seq:
+                return seq, []
+            if not self.events or self.events[0][0] > seq + 1:
+                return self.seq, None
+            return self.seq, [(e, d) for i, e, d in self.events if i > seq]
+
+
+live_events = EventBroker()
+
+
+@listens_for(Flight, 'after_update')
+@listens_for(Flight, 'after_delete')
+def clear_live_cache(mapper, connection, target):
+    entry = live_cache.get()
+    if entry is None or entry['flight'] is None or \
+            entry['flight']['id'] == target.id:
+        live_cache.clear()
+    live_flights_cache.clear()
+
+
+smartcars_actions = {
+    'manuallogin', 'automaticlogin', 'verifysession', 'getpilotcenterdata',
+    'getairports', 'getaircraft', 'getbidflights', 'positionreport',
+    'filepirep', 'bidonflight', 'deletebidflight', 'searchpireps',
+    'getpirepdata', 'searchflights', 'createflight',
+}
+
+
+class Metrics:
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+
+    def record(self, endpoint, action, elapsed, sql_count, sql_time):
+        with self.lock:
+            m = self.data.get((endpoint, action))
+            if m is None:
+                m = self.data[(endpoint, action)] = {
+                    'count': 0,
+                    'sum': 0.0,
+                    'buckets': [0] * len(self.buckets),
+                    'sql_count': 0,
+                    'sql_time': 0.0,
+                }
+            m['count'] += 1
+            m['sum'] += elapsed
+            for i, le in enumerate(self.buckets):
+                if elapsed <= le:
+                    m['buckets'][i] += 1
+                    break
+            m['sql_count'] += sql_count
+            m['sql_time'] += sql_time
+
+    def snapshot(self):
+        with self.lock:
+            return sorted((k, dict(v, buckets=list(v['buckets'])))
+                          for k, v in self.data.items())
+
+    def quantile(self, m, q):
+        # upper bound of the bucket holding the quantile
+        total = 0
+        for le, count in zip(self.buckets, m['buckets']):
+            total += count
+            if total >= q * m['count']:
+                return le
+        return None
+
+    def render(self):
+        rv = [
+            '# HELP myacars_requests_total Requests handled.',
+            '# TYPE myacars_requests_total counter',
+        ]
+        data = self.snapshot()
+        for (endpoint, action), m in data:
+            rv.append('myacars_requests_total{%s} %d' % (
+                self.labels(endpoint, action), m['count']))
+        rv += [
+            '# HELP myacars_request_duration_seconds Request latency.',
+            '# TYPE myacars_request_duration_seconds histogram',
+        ]
+        for (endpoint, action), m in data:
+            labels = self.labels(endpoint, action)
+            total = 0
+            for le, count in zip(self.buckets, m['buckets']):
+                total += count
+                rv.append('myacars_request_duration_seconds_bucket'
+                          '{%s,le="%s"} %d' % (labels, le, total))
+            rv.append('myacars_request_duration_seconds_bucket'
+                      '{%s,le="+Inf"} %d' % (labels, m['count']))
+            rv.append('myacars_request_duration_seconds_sum{%s} %f' % (
+                labels, m['sum']))
+            rv.append('myacars_request_duration_seconds_count{%s} %d' % (
+                labels, m['count']))
+        rv += [
+            '# HELP myacars_sql_statements_total SQL statements executed.',
+            '# TYPE myacars_sql_statements_total counter',
+        ]
+        for (endpoint, action), m in data:
+            rv.append('myacars_sql_statements_total{%s} %d' % (
+                self.labels(endpoint, action), m['sql_count']))
+        rv += [
+            '# HELP myacars_sql_duration_seconds_total Time spent in SQL.',
+            '# TYPE myacars_sql_duration_seconds_total counter',
+        ]
+        for (endpoint, action), m in data:
+            rv.append('myacars_sql_duration_seconds_total{%s} %f' % (
+                self.labels(endpoint, action), m['sql_time']))
+        return '\n'.join(rv) + '\n'
+
+    @staticmethod
+    def labels(endpoint, action):
+        return 'endpoint="%s",action="%s"' % (endpoint, action)
+
+
+metrics = Metrics()
+
+
+class MetricsView(BasicAuthMixin, BaseView):
+
+    @expose('/')
+    def index(self):
+        return self.render('admin/metrics.html', metrics=metrics)
+
+
+class Profiler:
+
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.slow_queries = deque(maxlen=size)
+        self.busy_requests = deque(maxlen=size)
+
+    def add_slow_query(self, entry):
+        with self.lock:
+            self.slow_queries.appendleft(entry)
+
+    def add_busy_request(self, entry):
+        with self.lock:
+            self.busy_requests.appendleft(entry)
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.slow_queries), list(self.busy_requests)
+
+    def clear(self):
+        with self.lock:
+            self.slow_queries.clear()
+            self.busy_requests.clear()
+
+    @staticmethod
+    def explain(conn, statement, parameters):
+        # a failed EXPLAIN would abort a PostgreSQL transaction
+        if not re_explainable.match(statement):
+            return None
+        if conn.dialect.name == 'sqlite':
+            prefix = 'EXPLAIN QUERY PLAN '
+        elif conn.dialect.name == 'postgresql':
+            prefix = 'EXPLAIN '
+        else:
+            return None
+        # a separate cursor, so the results of the statement are kept
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute(prefix + statement, parameters)
+            return [str(row[-1]) for row in cursor.fetchall()]
+        except Exception as e:
+            return ['EXPLAIN failed: %s' % e]
+        finally:
+            cursor.close()
+
+
+profiler = Profiler(app.config['SQL_PROFILE_SIZE'])
+
+
+class ProfilerView(BasicAuthMixin, BaseView):
+
+    @expose('/')
+    def index(self):
+        slow_queries, busy_requests = profiler.snapshot()
+        return self.render('admin/profiler.html',
+                           slow_queries=slow_queries,
+                           busy_requests=busy_requests)
+
+    @expose('/clear/', methods=['POST'])
+    def clear(self):
+        profiler.clear()
+        flash('Profiler entries cleared.')
+        return redirect(url_for('.index'))
+
+
+class PurgeJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    flight_ids = db.Column(db.Text, nullable=False)  # JSON list
+    total = db.Column(db.Integer, nullable=True)
+    deleted = db.Column(db.Integer, nullable=False, default=0)
+    flights = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow,
+                           nullable=False)
+    # the process running the job refreshes the heartbeat after every
+    # chunk. a job without a recent one is resumed by the next process
+    # looking at it, e.g. after the worker running it was restarted.
+    owner = db.Column(db.String(32), nullable=True)
+    heartbeat = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    error = db.Column(db.UnicodeText, nullable=True)
+
+    @classmethod
+    def create(cls, flight_ids):
+        job = cls(flight_ids=json.dumps(list(flight_ids)), deleted=0,
+                  flights=0)
+        db.session.add(job)
+        db.session.flush()
+        # only the latest finished jobs are kept
+        keep = db.session.query(cls.id).order_by(cls.id.desc()).limit(
+            app.config['PURGE_JOBS']).subquery()
+        cls.query.filter(cls.finished_at.isnot(None),
+                         cls.id.notin_(keep)).delete(synchronize_session=False)
+        db.session.commit()
+        return job.id
+
+    @classmethod
+    def latest(cls):
+        # unfinished jobs first
+        return cls.query.order_by(cls.finished_at.isnot(None),
+                                  cls.id.desc()).limit(
+            app.config['PURGE_JOBS']).all()
+
+    @classmethod
+    def claim(cls, id, owner):
+        # returns True if the job is now run by owner
+        table = cls.__table__
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=app.config['PURGE_JOB_TIMEOUT'])
+        with db.engine.begin() as conn:
+            return conn.execute(table.update().where(db.and_(
+                table.c.id == id,
+                table.c.finished_at.is_(None),
+                db.or_(table.c.heartbeat.is_(None), table.c.heartbeat < stale),
+            )).values(owner=owner, heartbeat=now)).rowcount == 1
+
+    @classmethod
+    def update_progress(cls, conn, id, owner, **values):
+        # part of the transaction of each chunk, which is rolled back if
+        # another process took the job over meanwhile
+        table = cls.__table__
+        values['heartbeat'] = datetime.utcnow()
+        if conn.execute(table.update().where(db.and_(
+                table.c.id == id, table.c.owner == owner)).values(
+                    **values)).rowcount != 1:
+            raise RuntimeError('Purge job %d was taken over by another '
+                               'process' % id)
+
+    @property
+    def flight_id_list(self):
+        return json.loads(self.flight_ids)
+
+    @property
+    def stalled(self):
+        if self.finished_at is not None:
+            return False
+        if self.heartbeat is None:
+            return True
+        return (datetime.utcnow() - self.heartbeat).total_seconds() >= \
+            app.config['PURGE_JOB_TIMEOUT']
+
+    @property
+    def progress(self):
+        if not self.total:
+            return 0 if self.finished_at is None else 100
+        return min(self.deleted * 100 // self.total, 100)
+
+
+def run_purge_job(id):
+    # runs the job unless another process does, from where it was left.
+    # returns False if it runs elsewhere.
+    owner = os.urandom(16).hex()
+    if not PurgeJob.claim(id, owner):
+        return False
+    table = PurgeJob.__table__
+    pos = Position.__table__
+    chunk_size = app.config['PURGE_CHUNK_SIZE']
+    job = PurgeJob.query.get(id)
+    flight_ids = job.flight_id_list
+    done, total = job.flights, job.total
+    db.session.rollback()
+    error = None
+    try:
+        if total is None:
+            total = db.session.query(db.func.count(Position.id)).filter(
+                Position.flight_id.in_(flight_ids)).scalar()
+            db.session.rollback()
+            with db.engine.begin() as conn:
+                PurgeJob.update_progress(conn, id, owner, total=total)
+        for flight_id in flight_ids[done:]:
+            # a short transaction per chunk, so position reports and other
+            # requests are not blocked while a large track is removed
+            chunk = db.select([pos.c.id]).where(
+                pos.c.flight_id == flight_id).limit(chunk_size)
+            while True:
+                with db.engine.begin() as conn:
+                    deleted = conn.execute(
+                        pos.delete().where(pos.c.id.in_(chunk))).rowcount
+                    PurgeJob.update_progress(
+                        conn, id, owner, deleted=table.c.deleted + deleted)
+                if deleted < chunk_size:
+                    break
+
+            # the bid can be flown again from scratch
+            flt = Flight.query.get(flight_id)
+            if flt is not None:
+                flt.started_at = None
+                flt.last_seen = None
+                flt.diversion = None
+                flt.metrics = None
+                db.session.commit()
+            last_positions.pop(flight_id)
+            with db.engine.begin() as conn:
+                PurgeJob.update_progress(conn, id, owner,
+                                         flights=table.c.flights + 1)
+    except Exception as e:
+        app.logger.exception('Purge job %d failed', id)
+        db.session.rollback()
+        error = str(e)
+    with db.engine.begin() as conn:
+        conn.execute(table.update().where(db.and_(
+            table.c.id == id, table.c.owner == owner)).values(
+                finished_at=datetime.utcnow(), error=error))
+    return True
+
+
+def start_purge_job(id):
+    def run():
+        with app.app_context():
+            run_purge_job(id)
+
+    thread = threading.Thread(target=run, name='purge-job-%d' % id,
+                              daemon=True)
+    thread.start()
+
+
+class PurgeView(BasicAuthMixin, BaseView):
+
+    @expose('/')
+    def index(self):
+        jobs = PurgeJob.latest()
+        for job in jobs:
+            if job.stalled:
+                start_purge_job(job.id)
+        return self.render('admin/purge.html', jobs=jobs,
+                           running=any(i.finished_at is None for i in jobs))
 
 
 admin = Admin(app, name='myACARS', template_mode='bootstrap3',
@@ -302,24 +2015,119 @@ admin.add_view(AirportView(Airport, db.session))
 admin.add_view(AircraftView(Aircraft, db.session))
 admin.add_view(FlightView(Flight, db.session))
 admin.add_view(PositionView(Position, db.session))
+admin.add_view(MetricsView(name='Metrics', endpoint='metrics'))
+admin.add_view(PurgeView(name='Purge Jobs', endpoint='purge'))
+admin.add_view(ProfilerView(name='Profiler', endpoint='profiler'))
+
+
+@listens_for(Engine, 'before_cursor_execute')
+def sql_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@listens_for(Engine, 'after_cursor_execute')
+def sql_finished(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    if has_request_context() and 'sql_count' in g:
+        g.sql_count += 1
+        g.sql_time += elapsed
+        if 'sql_statements' in g:
+            g.sql_statements[statement] += 1
+    if not app.config['SQL_PROFILING'] or \
+            elapsed < app.config['SQL_SLOW_THRESHOLD']:
+        return
+    endpoint, action = get_request_label()
+    plan = None
+    if not executemany:
+        plan = profiler.explain(conn, statement, parameters)
+    profiler.add_slow_query({
+        'time': datetime.utcnow(),
+        'duration': elapsed,
+        'endpoint': endpoint,
+        'action': action,
+        'statement': statement,
+        'parameters': repr(parameters)[:1000],
+        'plan': plan,
+    })
+    app.logger.warning('Slow query (%.3fs) in %s %s: %s %r\n%s', elapsed,
+                       endpoint, action, statement, parameters,
+                       '\n'.join(plan or []))
+
+
+@listens_for(Engine, 'handle_error')
+def sql_failed(context):
+    starts = context.connection.info.get('query_start')
+    if starts:
+        starts.pop()
+
+
+def get_request_label():
+    if not has_request_context():
+        return 'none', ''
+    action = ''
+    if request.endpoint == 'smartcars_api':
+        action = request.args.get('action', '')
+        if action not in smartcars_actions:
+            action = 'other'
+    return request.endpoint or 'notfound', action
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.sql_count = 0
+    g.sql_time = 0.0
+    if app.config['SQL_PROFILING']:
+        g.sql_statements = Counter()
+
+
+@app.teardown_request
+def record_request_metrics(exc):
+    if 'request_start' not in g:
+        return
+    endpoint, action = get_request_label()
+    elapsed = time.perf_counter() - g.request_start
+    metrics.record(endpoint, action, elapsed, g.sql_count, g.sql_time)
+    if 'sql_statements' in g and \
+            g.sql_count > app.config['SQL_QUERY_LIMIT']:
+        statement, count = g.sql_statements.most_common(1)[0]
+        profiler.add_busy_request({
+            'time': datetime.utcnow(),
+            'duration': elapsed,
+            'endpoint': endpoint,
+            'action': action,
+            'path': request.full_path,
+            'sql_count': g.sql_count,
+            'sql_time': g.sql_time,
+            'statement': statement,
+            'repeated': count,
+        })
+        app.logger.warning('%s issued %d SQL statements, %d times: %s',
+                           request.full_path, g.sql_count, count, statement)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    auth = BasicAuthMixin()
+    if not app.config['METRICS_PUBLIC'] and not auth.is_accessible():
+        return auth.inaccessible_callback('metrics')
+    rv = make_response(metrics.render())
+    rv.mimetype = 'text/plain'
+    rv.headers['Content-Type'] += '; version=0.0.4'
+    return rv
 
 
 @app.context_processor
 def get_stats():
-    result = db.session.query(
-        db.func.count(Flight.id).label('total_flights'),
-        db.func.sum(Flight.landing_rate).label('total_landing_rate'),
-        db.func.sum(Flight.duration).label('total_duration'),
-    ).filter(
-        Flight.landing_rate.isnot(None),
-        Flight.log.isnot(None),
-    ).first()
-    total_hours = (result.total_duration or 0) // 60
-    total_minutes = (result.total_duration or 0) % 60
+    result = Stats.query.get(1)
+    if result is None:
+        result = Stats.rebuild()
+    total_hours = result.total_duration // 60
+    total_minutes = result.total_duration % 60
     return {
         'total_hours': '%02d:%02d:00' % (total_hours, total_minutes),
-        'total_flights': result.total_flights or 0,
-        'avg_landing_rate': ((result.total_landing_rate or 0) //
+        'total_flights': result.total_flights,
+        'avg_landing_rate': (result.total_landing_rate //
                              (result.total_flights or 1)),
     }
 
@@ -331,6 +2139,189 @@ def get_version():
     }
 
 
+def to_epoch(dt):
+    return dt.replace(tzinfo=timezone.utc).timestamp()
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    # great circle distance, in nautical miles
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) *
+         math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * 3440.065 * math.asin(min(1, math.sqrt(a)))
+
+
+def get_flight_header(flt):
+    ofp_url = None
+    if flt.ofp:
+        ofp_url = url_for('.ofp', filename=flt.ofp)
+    return {
+        'id': flt.id,
+        'html_title': str(flt.html_title),
+        'origin': str(flt.origin),
+        'destination': str(flt.destination),
+        'diversion': None if flt.diversion is None else str(flt.diversion),
+        'aircraft': str(flt.aircraft),
+        'route': flt.route,
+        'flight_level': str(flt.flight_level),
+        'ofp_url': ofp_url,
+        'geojson_url': url_for('.flight_geojson', id=flt.id,
+                               zoom=app.config['TRACK_ZOOM']),
+    }
+
+
+def get_near_airport(lat, lon):
+    near = nearest_airports(lat, lon,
+                            max_distance=app.config['LIVE_NEAR_DISTANCE'])
+    if not near:
+        return None
+    distance, apt = near[0]
+    return {
+        'icao': apt.icao,
+        'name': apt.name,
+        'distance': round(distance, 1),
+    }
+
+
+def get_position_data(pos):
+    return {
+        'heading': pos['heading'],
+        'ground_speed': pos['ground_speed'],
+        'altitude': pos['altitude'],
+        'latitude': pos['latitude'],
+        'longitude': pos['longitude'],
+        'near': get_near_airport(pos['latitude'], pos['longitude']),
+    }
+
+
+def get_live_data(entry):
+    rv = {'live': True}
+    rv.update(entry['flight'])
+    rv.update(entry['position'])
+    rv['metrics'] = entry.get('metrics')
+    return rv
+
+
+def get_live_delta(entry):
+    rv = {
+        'id': entry['flight']['id'],
+        'timestamp': entry['timestamp'],
+    }
+    rv.update(entry['position'])
+    rv['metrics'] = entry.get('metrics')
+    return rv
+
+
+def update_live(flt, pos, metrics=None):
+    now = time.time()
+    entry = live_cache.get()
+    started = entry is None or entry['flight'] is None or \
+        entry['flight']['id'] != pos['flight_id']
+    if started:
+        header = get_flight_header(flt)
+    else:
+        header = entry['flight']
+    update_live_flights(header, pos)
+    if started and entry is not None and entry['flight'] is not None and \
+            now - entry['timestamp'] < 60:
+        return  # keep showing the flight that went live first
+    if metrics is not None:
+        metrics = FlightMetrics.summarize(metrics)
+    elif not started:
+        metrics = entry.get('metrics')
+    entry = {
+        'checked': now,
+        'timestamp': to_epoch(pos['timestamp']),
+        'flight': header,
+        'position': get_position_data(pos),
+        'metrics': metrics,
+    }
+    live_cache.set(entry)
+    if started:
+        live_events.publish('start', get_live_data(entry))
+    else:
+        live_events.publish('position', get_live_delta(entry))
+
+
+def get_live():
+    now = time.time()
+    entry = live_cache.get()
+    if entry is not None and \
+            now - entry['checked'] < app.config['LIVE_CACHE_RECHECK']:
+        if entry['flight'] is not None and now - entry['timestamp'] < 60:
+            return entry
+        return None
+
+    # cache is empty or stale, check the database. positions may have been
+    # reported to another worker process, or the pirep filed there.
+    entry = {
+        'checked': now,
+        'timestamp': None,
+        'flight': None,
+        'position': None,
+        'metrics': None,
+    }
+    active = Position.get_active_position()
+    if active is not None and active.flight.log is not None:
+        active = None  # pirep already filed
+    if active is not None:
+        metrics = active.flight.metrics
+        entry.update(
+            timestamp=to_epoch(active.flight.last_seen),
+            flight=get_flight_header(active.flight),
+            position=get_position_data(active.as_dict()),
+            metrics=None if metrics is None else metrics.summary,
+        )
+    live_cache.set(entry)
+    if active is None:
+        return None
+    return entry
+
+
+def get_live_flight(header, pos):
+    rv = dict(header, timestamp=to_epoch(pos['timestamp']))
+    rv.update(get_position_data(pos))
+    return rv
+
+
+def update_live_flights(header, pos):
+    entry = live_flights_cache.get()
+    if entry is None:
+        return  # built from the database on the next request
+    flights = [i for i in entry['flights'] if i['id'] != header['id']]
+    flights.append(get_live_flight(header, pos))
+    entry['flights'] = flights
+    live_flights_cache.set(entry)
+
+
+def get_live_flights():
+    now = time.time()
+    entry = live_flights_cache.get()
+    if entry is None or \
+            now - entry['checked'] >= app.config['LIVE_CACHE_RECHECK']:
+        entry = {
+            'checked': now,
+            'flights': [
+                get_live_flight(get_flight_header(pos.flight),
+                                dict(pos.as_dict(),
+                                     timestamp=pos.flight.last_seen))
+                for pos in Position.get_active_positions()
+            ],
+        }
+        live_flights_cache.set(entry)
+    return sorted((i for i in entry['flights'] if now - i['timestamp'] < 60),
+                  key=lambda i: i['id'])
+
+
+def in_bbox(flight, west, south, east, north):
+    if not south <= flight['latitude'] <= north:
+        return False
+    if west <= east:
+        return west <= flight['longitude'] <= east
+    # the box crosses the antimeridian
+    return flight['longitude'] >= west or flight['longitude'] <= east
+
+
 def build_response(separator, *args):
     return separator.join([str(i).replace(separator, '') for i in args])
 
@@ -350,6 +2341,66 @@ def get_response_user():
     )
 
 
+def get_response_airports():
+    qs = db.session.query(
+        Airport.id,
+        Airport.icao,
+        Airport.name,
+        Airport.latitude,
+        Airport.longitude,
+        Airport.country,
+    ).all()
+    if not qs:
+        return 'NO_DATA'
+    return build_response(
+        ';',
+        *[
+            build_response(
+                '|',
+                apt.id,
+                apt.icao.upper(),
+                apt.name,
+                apt.latitude,
+                apt.longitude,
+                apt.country,
+            )
+            for apt in qs
+        ]
+    )
+
+
+def get_response_aircraft():
+    qs = db.session.query(
+        Aircraft.id,
+        Aircraft.name,
+        Aircraft.icao,
+        Aircraft.registration,
+        Aircraft.max_passengers,
+        Aircraft.max_cargo,
+    ).all()
+    return build_response(
+        ';',
+        *[
+            build_response(
+                ',',
+                acf.id,
+                acf.name,
+                acf.icao,
+                acf.registration,
+                acf.max_passengers,
+                acf.max_cargo,
+                app.config['RANK_LEVEL'],
+            )
+            for acf in qs
+        ]
+    )
+
+
+def send_cached_response(key, func):
+    return get_cached(
+        key, lambda: CachedResponse(func().encode('utf-8'))).send()
+
+
 @app.route('/smartcars/', methods=['GET', 'POST'])
 def smartcars_api():
     action = request.args.get('action')
@@ -357,25 +2408,32 @@ def smartcars_api():
     if action == 'manuallogin':
         if request.args.get('userid') == app.config['USERID'] and \
            request.form.get('password') == app.config['PASSWORD']:
-            sess = Session(sessionid=request.args.get('sessionid'))
+            Session.expire_periodically()
+            sessionid = request.args.get('sessionid')
+            timestamp = datetime.utcnow()
+            sess = Session(sessionid=sessionid, timestamp=timestamp)
             db.session.add(sess)
             db.session.commit()
+            session_cache.set(sessionid, timestamp)
             return get_response_user()
         return 'AUTH_FAILED'
 
     elif action == 'automaticlogin':
         if request.args.get('dbid') != '1':
             return 'AUTH_FAILED'
-        if not request.args.get('oldsessionid'):
+        oldsessionid = request.args.get('oldsessionid')
+        if not Session.is_valid(oldsessionid):
             return 'AUTH_FAILED'
-        sess = Session.query.filter_by(
-            sessionid=request.args.get('oldsessionid')).first()
-        if sess is None:
-            return 'AUTH_FAILED'
-        sessnew = Session(sessionid=request.args.get('sessionid'))
-        db.session.delete(sess)
+        Session.expire_periodically()
+        Session.query.filter_by(sessionid=oldsessionid).delete(
+            synchronize_session=False)
+        session_cache.pop(oldsessionid)
+        sessionid = request.args.get('sessionid')
+        timestamp = datetime.utcnow()
+        sessnew = Session(sessionid=sessionid, timestamp=timestamp)
         db.session.add(sessnew)
         db.session.commit()
+        session_cache.set(sessionid, timestamp)
         return get_response_user()
 
     elif action == 'verifysession':
@@ -383,13 +2441,11 @@ def smartcars_api():
             return 'AUTH_FAILED'
         if request.args.get('dbid') != '1':
             return 'AUTH_FAILED'
-        sess = Session.query.filter_by(
-            sessionid=request.args.get('sessionid')).first()
-        if sess is None:
+        if not Session.is_valid(request.args.get('sessionid')):
             return 'AUTH_FAILED'
         return build_response(
             ',',
-            sess.sessionid,
+            request.args.get('sessionid'),
             app.config['FIRST_NAME'],
             app.config['LAST_NAME'],
         )
@@ -407,48 +2463,10 @@ def smartcars_api():
         )
 
     elif action == 'getairports':
-        airports = []
-        qs = Airport.query.all()
-        if qs:
-            for apt in qs:
-                airports.append(
-                    build_response(
-                        '|',
-                        apt.id,
-                        apt.icao.upper(),
-                        apt.name,
-                        apt.latitude,
-                        apt.longitude,
-                        apt.country,
-                    )
-                )
-        else:
-            return 'NO_DATA'
-        return build_response(
-            ';',
-            *airports
-        )
+        return send_cached_response('getairports', get_response_airports)
 
     elif action == 'getaircraft':
-        aircrafts = []
-        qs = Aircraft.query.all()
-        for acf in qs:
-            aircrafts.append(
-                build_response(
-                    ',',
-                    acf.id,
-                    acf.name,
-                    acf.icao,
-                    acf.registration,
-                    acf.max_passengers,
-                    acf.max_cargo,
-                    app.config['RANK_LEVEL'],
-                )
-            )
-        return build_response(
-            ';',
-            *aircrafts
-        )
+        return send_cached_response('getaircraft', get_response_aircraft)
 
     elif action == 'getbidflights':
         flights = []
@@ -486,11 +2504,7 @@ def smartcars_api():
     elif action == 'positionreport':
         if request.args.get('dbid') != '1':
             return 'AUTH_FAILED'
-        if not request.args.get('sessionid'):
-            return 'AUTH_FAILED'
-        sess = Session.query.filter_by(
-            sessionid=request.args.get('sessionid')).first()
-        if sess is None:
+        if not Session.is_valid(request.args.get('sessionid')):
             return 'AUTH_FAILED'
         flt = Flight.query.get(int(request.args.get('bidid')))
         if flt is None:
@@ -508,31 +2522,46 @@ def smartcars_api():
         if lat < 0.005 and lat > -0.005:
             lat = 0
 
-        pos = Position(
-            flight=flt,
+        values = dict(
+            flight_id=flt.id,
             latitude=lat,
             longitude=lon,
             altitude=int(request.args.get('altitude', 0)),
             heading=int(request.args.get('magneticheading', 0)),
             ground_speed=int(request.args.get('groundspeed', 0)),
             phase=int(request.args.get('phase', 0)),
+            timestamp=datetime.utcnow(),
         )
-        db.session.add(pos)
+        if flt.started_at is None:
+            flt.started_at = values['timestamp']
+        flt.check_diversion(lat, lon, values['ground_speed'])
+        try:
+            metrics = store_position(values, check_position(values))
+        except RuntimeError as e:
+            app.logger.error('Not storing position report of flight %d: %s',
+                             flt.id, e)
+            return 'ERROR'
+        touch_last_seen(flt.id, values['timestamp'])
         db.session.commit()
+        update_live(flt, values, metrics)
         return 'SUCCESS'
 
     elif action == 'filepirep':
         if request.args.get('dbid') != '1':
             return 'AUTH_FAILED'
-        if not request.args.get('sessionid'):
-            return 'AUTH_FAILED'
-        sess = Session.query.filter_by(
-            sessionid=request.args.get('sessionid')).first()
-        if sess is None:
+        if not Session.is_valid(request.args.get('sessionid')):
             return 'AUTH_FAILED'
         flt = Flight.query.get(int(request.args.get('bidid')))
         if flt is None:
             return 'ERROR'
+
+        # make sure that the whole track is stored before filing the pirep
+        try:
+            position_writer.flush()
+        except RuntimeError:
+            app.logger.exception('Not filing pirep of flight %d', flt.id)
+            return 'ERROR'
+
         route = request.form.get('route')
         if route is not None and route != flt.route:
             flt.route = route
@@ -542,7 +2571,18 @@ def smartcars_api():
         time = datetime.strptime(request.args.get('flighttime', '00.00'),
                                  '%H.%M').time()
         flt.duration = time.minute + (60 * time.hour)
+
+        # the live entry is cleared by the commit. other flights may be
+        # active, but only the one being shown ends the live tracking.
+        entry = live_cache.get()
+        shown = entry is not None and entry['flight'] is not None and \
+            entry['flight']['id'] == flt.id
         db.session.commit()
+        if shown:
+            live_events.publish('end', {'id': flt.id, 'live': False})
+        if app.config['POSITION_ARCHIVE']:
+            flt.archive()
+            db.session.commit()
         return 'SUCCESS'
 
     # The following actions are not supported by myACARS
@@ -573,9 +2613,37 @@ def smartcars_api():
 
 @app.route('/')
 def home():
-    return render_template('home.html',
-                           flights=Flight.complete_flights().order_by(
-                               Flight.id.desc()), menu_flights=True)
+    qs = Flight.complete_flights().options(
+        db.defer(Flight.log),
+        db.defer(Flight.comments),
+        db.joinedload(Flight.origin),
+        db.joinedload(Flight.destination),
+        db.joinedload(Flight.aircraft),
+    )
+    before = request.args.get('before', type=int)
+    if before is not None:
+        qs = qs.filter(Flight.id < before)
+    per_page = app.config['FLIGHTS_PER_PAGE']
+    flights = qs.order_by(Flight.id.desc()).limit(per_page + 1).all()
+    next_before = None
+    if len(flights) > per_page:
+        flights = flights[:per_page]
+        next_before = flights[-1].id
+    return render_template('home.html', flights=flights,
+                           next_before=next_before,
+                           first_page=before is None, menu_flights=True)
+
+
+@app.route('/search/')
+def search():
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = app.config['SEARCH_RESULTS_PER_PAGE']
+    results = search_flights(query, per_page + 1, (page - 1) * per_page,
+                             complete=True)
+    return render_template('search.html', query=query, page=page,
+                           results=results[:per_page],
+                           has_next=len(results) > per_page)
 
 
 @app.route('/ofp/<filename>')
@@ -592,29 +2660,90 @@ def live():
 
 @app.route('/live/json/')
 def live_json():
-    active = Position.get_active_position()
-    if active is None:
+    live = get_live()
+    if live is None:
         return jsonify({'live': False})
-    ofp_url = None
-    if active.flight.ofp:
-        ofp_url = url_for('.ofp', filename=active.flight.ofp)
-    return jsonify({
-        'live': True,
-        'id': active.flight.id,
-        'html_title': active.flight.html_title,
-        'origin': str(active.flight.origin),
-        'destination': str(active.flight.destination),
-        'aircraft': str(active.flight.aircraft),
-        'route': active.flight.route,
-        'flight_level': str(active.flight.flight_level),
-        'ofp_url': ofp_url,
-        'geojson_url': url_for('.flight_geojson', id=active.flight.id),
-        'heading': active.heading,
-        'ground_speed': active.ground_speed,
-        'altitude': active.altitude,
-        'latitude': active.latitude,
-        'longitude': active.longitude,
-    })
+    return jsonify(get_live_data(live))
+
+
+@app.route('/airports/nearest/')
+def airports_nearest():
+    try:
+        lat = float(request.args['latitude'])
+        lon = float(request.args['longitude'])
+    except (KeyError, ValueError):
+        abort(400)
+    count = min(max(request.args.get('count', 1, type=int), 1), 50)
+    max_distance = request.args.get('max_distance', type=float)
+    return jsonify({'airports': [
+        dict(apt._asdict(), distance=round(distance, 1))
+        for distance, apt in nearest_airports(lat, lon, count, max_distance)
+    ]})
+
+
+@app.route('/live/flights/')
+def live_flights():
+    flights = get_live_flights()
+    if 'bbox' in request.args:
+        try:
+            west, south, east, north = [
+                float(i) for i in request.args['bbox'].split(',')]
+        except ValueError:
+            abort(400)
+        flights = [i for i in flights
+                   if in_bbox(i, west, south, east, north)]
+    return jsonify({'flights': flights})
+
+
+def format_event(event, data):
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+
+
+@app.route('/live/stream/')
+def live_stream():
+    keepalive = app.config['LIVE_STREAM_KEEPALIVE']
+    deadline = time.time() + app.config['LIVE_STREAM_TIMEOUT']
+
+    def check_live(current):
+        # positions may have been reported to another worker process
+        live = get_live()
+        db.session.remove()
+        if live is None:
+            if current is not None:
+                return None, format_event('end', {
+                    'id': current['flight']['id'],
+                    'live': False,
+                })
+        elif current is None or \
+                current['flight']['id'] != live['flight']['id']:
+            return live, format_event('start', get_live_data(live))
+        elif current['timestamp'] != live['timestamp']:
+            return live, format_event('position', get_live_delta(live))
+        return live, None
+
+    def stream():
+        seq = live_events.seq
+        yield 'retry: %d\n\n' % (keepalive * 1000)
+        current, event = check_live(None)
+        yield event or format_event('end', {'live': False})
+        while time.time() < deadline:
+            seq, events = live_events.wait(seq, keepalive)
+            if events:
+                for event, data in events:
+                    yield format_event(event, data)
+                current = live_cache.get()
+                if current is not None and current['flight'] is None:
+                    current = None
+                continue
+            if events is None:
+                current = None
+            current, event = check_live(current)
+            yield event or ': keepalive\n\n'
+
+    rv = Response(stream_with_context(stream()), mimetype='text/event-stream')
+    rv.headers['Cache-Control'] = 'no-cache'
+    rv.headers['X-Accel-Buffering'] = 'no'
+    return rv
 
 
 @app.route('/flight/<int:id>/')
@@ -625,29 +2754,214 @@ def flight(id):
     return render_template('flight.html', flight=flt, menu_flights=True)
 
 
-@app.route('/flight/<int:id>/geojson/')
-def flight_geojson(id):
-    flt = Flight.query.get_or_404(id)
-    positions = flt.positions_filtered
+def is_array(value):
+    return numpy is not None and isinstance(value, numpy.ndarray)
+
+
+def simplify_track(x, y, tolerance):
+    # Douglas-Peucker, returns the indexes of the points to keep. vectorized
+    # when called with numpy arrays.
+    if len(x) < 3 or not tolerance:
+        return list(range(len(x)))
+    vectorized = is_array(x)
+    keep = [False] * len(x)
+    keep[0] = keep[-1] = True
+    tolerance = tolerance * tolerance
+    stack = [(0, len(x) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        x1 = x[first]
+        y1 = y[first]
+        dx = x[last] - x1
+        dy = y[last] - y1
+        norm = dx * dx + dy * dy
+        dmax = 0
+        index = None
+        if vectorized:
+            xs = x[first + 1:last] - x1
+            ys = y[first + 1:last] - y1
+            if norm:
+                t = numpy.clip((xs * dx + ys * dy) / norm, 0, 1)
+                xs = x[first + 1:last] - (x1 + t * dx)
+                ys = y[first + 1:last] - (y1 + t * dy)
+            d = xs * xs + ys * ys
+            i = int(numpy.argmax(d))
+            if d[i] > dmax:
+                dmax = d[i]
+                index = first + 1 + i
+        else:
+            for i in range(first + 1, last):
+                xi = x[i]
+                yi = y[i]
+                if norm:
+                    t = min(max(((xi - x1) * dx + (yi - y1) * dy) / norm, 0),
+                            1)
+                    xi -= x1 + t * dx
+                    yi -= y1 + t * dy
+                else:
+                    xi -= x1
+                    yi -= y1
+                d = xi * xi + yi * yi
+                if d > dmax:
+                    dmax = d
+                    index = i
+        if index is not None and dmax > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [i for i, k in enumerate(keep) if k]
+
+
+def get_track_tolerance():
+    tolerance = request.args.get('tolerance', type=float)
+    if tolerance is not None:
+        return max(tolerance, 0)
+    zoom = request.args.get('zoom', type=int)
+    if zoom is not None:
+        # roughly one pixel at the given zoom level, in degrees
+        return 360 / (256 * 2 ** min(max(zoom, 0), 24))
+    return None
+
+
+def downsample_lttb(x, y, threshold):
+    # Largest-Triangle-Three-Buckets, returns the indexes of the points to
+    # keep. vectorized within each bucket when called with numpy arrays.
+    # bucket averages come from prefix sums, so both versions pick the same
+    # points.
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    vectorized = is_array(x)
+    if vectorized:
+        sum_x = numpy.concatenate(([0], numpy.cumsum(x)))
+        sum_y = numpy.concatenate(([0], numpy.cumsum(y)))
+    else:
+        sum_x = [0] + list(accumulate(x))
+        sum_y = [0] + list(accumulate(y))
+    every = (n - 2) / (threshold - 2)
+    rv = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = (sum_x[next_end] - sum_x[end]) / (next_end - end)
+        avg_y = (sum_y[next_end] - sum_y[end]) / (next_end - end)
+        ax = x[a]
+        ay = y[a]
+        if vectorized:
+            area = numpy.abs((ax - avg_x) * (y[start:end] - ay) -
+                             (ax - x[start:end]) * (avg_y - ay))
+            a = start + int(numpy.argmax(area))
+        else:
+            amax = -1
+            for j in range(start, end):
+                area = abs((ax - avg_x) * (y[j] - ay) -
+                           (ax - x[j]) * (avg_y - ay))
+                if area > amax:
+                    amax = area
+                    a = j
+        rv.append(a)
+    rv.append(n - 1)
+    return rv
+
+
+def build_chart_data(cols, points):
+    # altitude and ground speed share the time axis: each series picks half
+    # of the points, and both keep the union
+    x = cols['timestamp']
+    half = max(points // 2, 3)
+    idx = sorted(set(downsample_lttb(x, cols['altitude'], half)) |
+                 set(downsample_lttb(x, cols['ground_speed'], half)))
+    if is_array(x):
+        return [
+            ['x'] + numpy.round(x[idx] * 1000).astype(numpy.int64).tolist(),
+            ['Altitude'] + cols['altitude'][idx].tolist(),
+            ['Ground Speed'] + cols['ground_speed'][idx].tolist(),
+        ]
+    return [
+        ['x'] + [int(round(x[i] * 1000)) for i in idx],
+        ['Altitude'] + [cols['altitude'][i] for i in idx],
+        ['Ground Speed'] + [cols['ground_speed'][i] for i in idx],
+    ]
+
+
+def summarize_track(cols):
+    # indexes of the points shown on the flight page: the route simplified
+    # at TRACK_ZOOM and the points of the chart
+    tolerance = 360 / (256 * 2 ** app.config['TRACK_ZOOM'])
+    half = max(app.config['CHART_POINTS'] // 2, 3)
+    idx = set(simplify_track(cols['longitude'], cols['latitude'], tolerance))
+    idx.update(downsample_lttb(cols['timestamp'], cols['altitude'], half))
+    idx.update(downsample_lttb(cols['timestamp'], cols['ground_speed'], half))
+    return sorted(idx)
+
+
+track_cache = LRUCache(app.config['TRACK_CACHE_SIZE'])
+
+
+def build_route_feature(cols, tolerance):
+    idx = simplify_track(cols['longitude'], cols['latitude'], tolerance)
+    if is_array(cols['longitude']):
+        coordinates = numpy.column_stack(
+            (cols['longitude'][idx], cols['latitude'][idx])).tolist()
+    else:
+        coordinates = [(cols['longitude'][i], cols['latitude'][i])
+                       for i in idx]
+    return {
+        'type': 'Feature',
+        'geometry': {
+            'type': 'LineString',
+            'coordinates': coordinates,
+        },
+        'properties': {
+            'type': 'route',
+            'flight_data': build_chart_data(cols, app.config['CHART_POINTS']),
+            'chart_points': app.config['CHART_POINTS'],
+        },
+    }
+
+
+def get_route_feature(flt, tolerance):
+    # positions are added or removed, and the latest one of a stop may take
+    # a later timestamp, so their count, latest id and latest timestamp are
+    # enough to detect changes in the track of a bid. completed flights only
+    # change when archived, and then all the positions are removed.
+    marker = db.session.query(
+        db.func.count(Position.id),
+        db.func.max(Position.id),
+        db.func.max(Position.timestamp),
+    ).filter(Position.flight_id == flt.id).first()
+    key = (flt.id, tolerance, flt.log is not None, tuple(marker))
+    rv = track_cache.get(key)
+    if rv is not None:
+        return rv
+
+    if numpy is not None:
+        cols = filter_track_columns(flt.get_track_columns(
+            ['latitude', 'longitude', 'altitude', 'heading', 'ground_speed',
+             'phase', 'timestamp']))
+    else:
+        positions = flt.positions_filtered
+        cols = {
+            'latitude': [i.latitude for i in positions],
+            'longitude': [i.longitude for i in positions],
+            'altitude': [i.altitude for i in positions],
+            'ground_speed': [i.ground_speed for i in positions],
+            'timestamp': [to_epoch(i.timestamp) for i in positions],
+        }
+    rv = build_route_feature(cols, tolerance)
+    track_cache.set(key, rv)
+    return rv
+
+
+def build_flight_geojson(flt, tolerance):
     rv = {
         'type': 'FeatureCollection',
         'features': [
-            {
-                'type': 'Feature',
-                'geometry': {
-                    'type': 'LineString',
-                    'coordinates': [
-                        (i.longitude, i.latitude) for i in positions
-                    ],
-                },
-                'properties': {
-                    'type': 'route',
-                    'flight_data': [
-                        ['Altitude'] + [i.altitude for i in positions],
-                        ['Ground Speed'] + [i.ground_speed for i in positions],
-                    ],
-                },
-            },
+            get_route_feature(flt, tolerance),
             {
                 'type': 'Feature',
                 'geometry': {
@@ -679,9 +2993,11 @@ def flight_geojson(id):
     if flt.log is None:
         lat = flt.origin.latitude
         lon = flt.origin.longitude
-        if len(flt.positions) > 0:
-            lat = flt.positions[-1].latitude
-            lon = flt.positions[-1].longitude
+        last = Position.query.filter_by(flight_id=flt.id).order_by(
+            Position.timestamp.desc()).first()
+        if last is not None:
+            lat = last.latitude
+            lon = last.longitude
         rv['features'] += [
             {
                 'type': 'Feature',
@@ -694,39 +3010,478 @@ def flight_geojson(id):
                 },
                 'properties': {
                     'type': 'plane',
+                    'cursor': None if last is None else last.id,
                 }
             },
         ]
-    return jsonify(rv)
+    return rv
+
+
+# bumped when the format changes, so that older artifacts are ignored
+geojson_version = 2
+
+
+def get_geojson_artifact(flt):
+    # completed flights never change, their geojson is stored compressed on
+    # disk for the full track and for the zoom presets.
+    if 'tolerance' in request.args:
+        return None
+    zoom = request.args.get('zoom', type=int)
+    name = 'full' if zoom is None else 'z%d' % min(max(zoom, 0), 24)
+    path = os.path.join(app.config['GEOJSON_PATH'], '%d-%s-v%d.json.gz' % (
+        flt.id, name, geojson_version))
+    # the etag is stored next to the artifact, and written after it, so
+    # revalidations are answered without reading the artifact
+    try:
+        with open(path + '.etag') as fp:
+            etag = fp.read()
+        if request.if_none_match.contains(etag):
+            return CachedResponse(etag=etag)
+        with open(path, 'rb') as fp:
+            return CachedResponse(data_gzip=fp.read(), etag=etag)
+    except OSError:
+        pass
+    data = json.dumps(build_flight_geojson(flt, get_track_tolerance()),
+                      separators=(',', ':')).encode('utf-8')
+    rv = CachedResponse(data)
+    for target, content in ((path, rv.data_gzip),
+                            (path + '.etag', rv.etag.encode('ascii'))):
+        tmp = '%s.%d' % (target, os.getpid())
+        with open(tmp, 'wb') as fp:
+            fp.write(content)
+        os.replace(tmp, target)
+    return rv
 
 
-@manager.command
-def populate_airports():
+@app.route('/flight/<int:id>/geojson/')
+def flight_geojson(id):
+    flt = Flight.query.get_or_404(id)
+    if flt.log is not None:
+        rv = get_geojson_artifact(flt)
+        if rv is not None:
+            return rv.send('application/json',
+                           max_age=app.config['GEOJSON_MAX_AGE'])
+    return jsonify(build_flight_geojson(flt, get_track_tolerance()))
+
+
+position_fields = ['id', 'timestamp', 'latitude', 'longitude', 'altitude',
+                   'heading', 'ground_speed', 'phase']
+
+
+def positions_after(flight_id, after):
+    pos = Position.__table__
+    query = db.select([pos.c[i] for i in position_fields]).where(
+        db.and_(pos.c.flight_id == flight_id, pos.c.id > after))
+    if after:
+        # the timestamp bound lets the flight_id/timestamp index narrow the
+        # scan down to the new positions. if the cursor's position was
+        # deleted meanwhile, only its id bounds them.
+        since = db.select([pos.c.timestamp]).where(pos.c.id == after)
+        query = query.where(pos.c.timestamp >= db.func.coalesce(
+            since.as_scalar(), datetime.min))
+    return query.order_by(pos.c.timestamp, pos.c.id)
+
+
+@app.route('/flight/<int:id>/positions/')
+def flight_positions(id):
+    # positions reported after the client's cursor, as compact arrays. idle
+    # pollers get 304 Not Modified after two indexed lookups.
+    flt = Flight.query.get_or_404(id)
+    after = request.args.get('after', 0, type=int)
+    pos = Position.__table__
+    latest = db.session.execute(
+        db.select([pos.c.id])
+        .where(pos.c.flight_id == flt.id)
+        .order_by(pos.c.timestamp.desc())
+        .limit(1)
+    ).scalar()
+    cursor = max(latest or 0, after)
+    etag = '%d-%d-%d-%d' % (flt.id, after, cursor, flt.log is not None)
+    if request.if_none_match.contains(etag):
+        rv = make_response('', 304)
+    else:
+        positions = []
+        if cursor > after:
+            for row in db.session.execute(positions_after(flt.id, after)):
+                row = list(row)
+                row[1] = to_epoch(row[1])
+                positions.append(row)
+        rv = jsonify({
+            'id': flt.id,
+            'complete': flt.log is not None,
+            'cursor': cursor,
+            'fields': position_fields,
+            'positions': positions,
+        })
+    rv.set_etag(etag)
+    rv.cache_control.no_cache = True
+    return rv
+
+
+def read_lines(source):
+    if re.match(r'^https?://', source):
+        resp = requests.get(source, stream=True)
+        resp.raise_for_status()
+        resp.encoding = 'utf-8'
+        yield from resp.iter_lines(decode_unicode=True)
+    else:
+        with open(source, newline='', encoding='utf-8') as fp:
+            yield from fp
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+@manager.option('-s', '--source', dest='source',
+                default='http://ourairports.com/data/airports.csv',
+                help='URL or local path of the airports.csv file')
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int,
+                default=1000, help='number of rows per bulk statement')
+def populate_airports(source, chunk_size):
     '''Load (large and medium) airports from ourairports.com'''
-    resp = requests.get('http://ourairports.com/data/airports.csv')
-    resp.raise_for_status()
+    start = time.monotonic()
+    existing = {
+        apt.icao: apt
+        for apt in db.session.query(Airport.id, Airport.icao, Airport.name,
+                                    Airport.latitude, Airport.longitude,
+                                    Airport.country)
+    }
 
-    reader = DictReader(StringIO(resp.content.decode('utf-8')))
-    for line in reader:
+    inserts = OrderedDict()
+    updates = OrderedDict()
+    rows = unchanged = skipped = 0
+    for line in DictReader(read_lines(source)):
+        rows += 1
         if not line['gps_code']:
+            skipped += 1
             continue
         if line['type'] not in ('medium_airport', 'large_airport'):
+            skipped += 1
             continue
         if len(line['gps_code']) > 4:
             raise RuntimeError('Invalid ICAO: %s' % line['gps_code'])
-        print(line['gps_code'], '-', line['name'])
-        apt = Airport.query.filter_by(icao=line['gps_code']).first()
-        create_apt = apt is None
-        if create_apt:
-            apt = Airport(icao=line['gps_code'])
-        apt.name = line['name']
-        apt.latitude = line['latitude_deg']
-        apt.longitude = line['longitude_deg']
-        apt.country = line['iso_country']
-        if create_apt:
-            db.session.add(apt)
+        values = {
+            'icao': line['gps_code'],
+            'name': line['name'],
+            'latitude': float(line['latitude_deg']),
+            'longitude': float(line['longitude_deg']),
+            'country': line['iso_country'],
+        }
+        apt = existing.get(values['icao'])
+        if apt is None:
+            inserts[values['icao']] = values
+        elif (apt.name, apt.latitude, apt.longitude, apt.country) == \
+                (values['name'], values['latitude'], values['longitude'],
+                 values['country']):
+            updates.pop(values['icao'], None)
+            unchanged += 1
+        else:
+            values['id'] = apt.id
+            updates[values['icao']] = values
+
+    for chunk in chunks(list(inserts.values()), chunk_size):
+        db.session.bulk_insert_mappings(Airport, chunk)
+    for chunk in chunks(list(updates.values()), chunk_size):
+        db.session.bulk_update_mappings(Airport, chunk)
+    if inserts or updates:
+        # bulk operations don't trigger mapper events
+        bump_cache_version(db.session.connection(), 'airports')
     db.session.commit()
 
+    elapsed = time.monotonic() - start
+    print('Inserted: %d, updated: %d, unchanged: %d, skipped: %d' % (
+        len(inserts), len(updates), unchanged, skipped))
+    print('Processed %d rows in %.2fs (%.0f rows/s)' % (
+        rows, elapsed, rows / (elapsed or 1)))
+
+
+def synthetic_track(count, start=None, seed=0):
+    rand = random.Random(seed)
+    if start is None:
+        start = datetime.utcnow() - timedelta(seconds=5 * count)
+    hold = count // 20
+    rv = []
+    for i in range(count):
+        # ground holds with repeated reports at both ends of the flight
+        j = min(max(i - hold, 0), count - 2 * hold)
+        frac = j / max(count - 2 * hold, 1)
+        airborne = 0 < j < count - 2 * hold
+        rv.append(TrackPoint(
+            latitude=-23.43 + 10 * frac + 0.05 * math.sin(j / 50),
+            longitude=-46.47 + 20 * frac + 0.05 * math.cos(j / 70),
+            altitude=int(35000 * math.sin(math.pi * frac)) if airborne else 0,
+            heading=(45 + j // 100) % 360,
+            ground_speed=rand.randint(420, 460) if airborne else 0,
+            phase=5 if airborne else 1,
+            timestamp=start + timedelta(seconds=5 * i),
+        ))
+    return rv
+
+
+@manager.option('-u', '--url', dest='url', default=None,
+                help='base URL of a running instance (default: in-process)')
+@manager.option('-c', '--clients', dest='clients', type=int, default=1,
+                help='number of simulated smartCARS clients')
+@manager.option('-b', '--browsers', dest='browsers', type=int, default=10,
+                help='number of simulated browsers polling /live/json/')
+@manager.option('-r', '--rate', dest='rate', type=float, default=1,
+                help='position reports per second, per client')
+@manager.option('-n', '--points', dest='points', type=int, default=100,
+                help='position reports per client (synthetic routes)')
+@manager.option('-f', '--replay', dest='replay', type=int, default=None,
+                help='replay the track of this flight id')
+@manager.option('-i', '--poll-interval', dest='poll_interval', type=float,
+                default=15, help='seconds between browser polls')
+@manager.option('--skip-pirep', dest='skip_pirep', action='store_true',
+                help="don't file a pirep at the end of the flights")
+@manager.option('--file-pireps', dest='file_pireps', action='store_true',
+                help='file pireps for the bids of the instance given by '
+                '--url, turning them into completed flights')
+def loadtest(url, clients, browsers, rate, points, replay, poll_interval,
+             skip_pirep, file_pireps):
+    '''Simulate smartCARS clients and browsers, reporting latencies'''
+    track = None
+    if replay is not None:
+        flt = Flight.query.get(replay)
+        if flt is None:
+            raise SystemExit('Flight not found: %d' % replay)
+        fields = ['latitude', 'longitude', 'altitude', 'heading',
+                  'ground_speed', 'phase']
+        track = [[getattr(pos, i) for i in fields]
+                 for pos in flt.track_points]
+    db.session.remove()
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'loadtest.py')
+    if url is None:
+        # in-process runs use a throwaway instance in a process of their
+        # own, and never touch the configured database
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as fp:
+            json.dump(track, fp)
+            fp.flush()
+            cmd = [sys.executable, script, '-c', str(clients),
+                   '-b', str(browsers), '-r', str(rate), '-n', str(points),
+                   '-i', str(poll_interval)]
+            if track is not None:
+                cmd += ['-t', fp.name]
+            if skip_pirep:
+                cmd.append('--skip-pirep')
+            rv = subprocess.call(cmd)
+        if rv:
+            raise SystemExit(rv)
+        return
+
+    from loadtest import Report, run
+    if not skip_pirep and not file_pireps:
+        print('Not filing pireps for the bids of %s, use --file-pireps to '
+              'file them.' % url)
+    run(url.rstrip('/'), clients, browsers, points, poll_interval, {
+        'userid': app.config['USERID'],
+        'password': app.config['PASSWORD'],
+        'rate': rate,
+        'pirep': not skip_pirep and file_pireps,
+    }, None if track is None else [Report(*i) for i in track])
+
+
+@manager.option('-n', '--points', dest='points', default='10000,100000',
+                help='comma separated list of track sizes')
+@manager.option('-r', '--repeat', dest='repeat', type=int, default=5)
+def benchmark_track(points, repeat):
+    '''Compare the Python and NumPy position pipelines'''
+    if numpy is None:
+        raise SystemExit('NumPy is not installed')
+    names = ['latitude', 'longitude', 'altitude', 'heading', 'ground_speed',
+             'phase']
+    for count in [int(i) for i in points.split(',')]:
+        positions = synthetic_track(count)
+        cols = {i: [getattr(p, i) for p in positions] for i in names}
+        cols['timestamp'] = [to_epoch(p.timestamp) for p in positions]
+        tolerance = 360 / (256 * 2 ** app.config['TRACK_ZOOM'])
+
+        def run_python():
+            filtered = filter_positions(positions)
+            return build_route_feature({
+                'latitude': [i.latitude for i in filtered],
+                'longitude': [i.longitude for i in filtered],
+                'altitude': [i.altitude for i in filtered],
+                'ground_speed': [i.ground_speed for i in filtered],
+                'timestamp': [to_epoch(i.timestamp) for i in filtered],
+            }, tolerance)
+
+        def run_numpy():
+            return build_route_feature(filter_track_columns(cols), tolerance)
+
+        if json.dumps(run_python()) != json.dumps(run_numpy()):
+            raise SystemExit('Pipelines output differ for %d points' % count)
+        t_python = min(timeit.repeat(run_python, number=1, repeat=repeat))
+        t_numpy = min(timeit.repeat(run_numpy, number=1, repeat=repeat))
+        print('%7d points: python %.4fs, numpy %.4fs (%.1fx)' % (
+            count, t_python, t_numpy, t_python / t_numpy))
+
+
+@manager.command
+def archive_positions():
+    '''Pack positions of completed flights into Flight.track'''
+    count = 0
+    for id, in db.session.query(Flight.id).filter(
+            Flight.log.isnot(None), Flight.track.is_(None)).all():
+        if Flight.query.get(id).archive():
+            db.session.commit()
+            count += 1
+        db.session.expunge_all()
+    print('Archived flights:', count)
+
+
+@manager.option('-b', '--bid-days', dest='bid_days', type=int,
+                default=None, help='purge positions of bids not flown in '
+                'this many days (default: RETENTION_BID_DAYS)')
+@manager.option('-c', '--completed-days', dest='completed_days', type=int,
+                default=None, help='keep only a summary of the track of '
+                'flights older than this many days '
+                '(default: RETENTION_COMPLETED_DAYS)')
+def purge_positions(bid_days, completed_days):
+    '''Purge old positions according to the retention policy'''
+    if bid_days is None:
+        bid_days = app.config['RETENTION_BID_DAYS']
+    if completed_days is None:
+        completed_days = app.config['RETENTION_COMPLETED_DAYS']
+    now = datetime.utcnow()
+
+    # jobs interrupted by a restart
+    for job in PurgeJob.latest():
+        if job.stalled and run_purge_job(job.id):
+            print('Resumed purge job %d' % job.id)
+
+    if bid_days is not None:
+        cutoff = now - timedelta(days=bid_days)
+        ids = [id for id, in db.session.query(Flight.id).filter(
+            Flight.log.is_(None),
+            db.func.coalesce(Flight.last_seen, Flight.started_at) < cutoff,
+            Flight.positions.any(),
+        ).order_by(Flight.id).all()]
+        db.session.rollback()
+        id = PurgeJob.create(ids)
+        run_purge_job(id)
+        job = PurgeJob.query.get(id)
+        if job.error is not None:
+            print('Purge failed:', job.error)
+            return
+        print('Purged %d positions of %d bids' % (job.deleted, job.flights))
+
+    if completed_days is not None:
+        cutoff = now - timedelta(days=completed_days)
+        count = 0
+        for id, in db.session.query(Flight.id).filter(
+                Flight.log.isnot(None), Flight.track.is_(None),
+                Flight.started_at < cutoff).all():
+            if Flight.query.get(id).archive(summary=True):
+                db.session.commit()
+                count += 1
+            db.session.expunge_all()
+        print('Summarized tracks of %d completed flights' % count)
+
+
+@manager.option('-f', '--flight', dest='flight_id', type=int, default=None,
+                help='only recompute the metrics of this flight')
+def recompute_metrics(flight_id):
+    '''Recompute the running metrics of flights from their positions'''
+    query = db.session.query(Flight.id).order_by(Flight.id)
+    if flight_id is not None:
+        query = query.filter(Flight.id == flight_id)
+    table = FlightMetrics.__table__
+    count = 0
+    for id, in query.all():
+        flt = Flight.query.get(id)
+        positions = [{
+            'flight_id': id,
+            'latitude': i.latitude,
+            'longitude': i.longitude,
+            'altitude': i.altitude,
+            'ground_speed': i.ground_speed,
+            'phase': i.phase,
+            'timestamp': i.timestamp,
+        } for i in flt.track_points]
+        conn = db.session.connection()
+        conn.execute(table.delete().where(table.c.flight_id == id))
+        if positions:
+            update_flight_metrics(conn, positions)
+        db.session.commit()
+        db.session.expunge_all()
+        count += 1
+    print('Recomputed metrics of %d flights' % count)
+
+
+@manager.command
+def rebuild_stats():
+    '''Rebuild pilot statistics from completed flights'''
+    stats = Stats.rebuild()
+    print('Flights: %d, duration: %d min, landing rate sum: %d fpm' % (
+        stats.total_flights, stats.total_duration, stats.total_landing_rate))
+
+
+@manager.command
+def expire_sessions():
+    '''Delete smartCARS sessions older than SESSION_LIFETIME'''
+    print('Expired sessions:', Session.expire())
+
+
+@manager.command
+def check_query_plans():
+    '''Check that hot queries don't fall back to full table scans (SQLite)'''
+    # the schema is built by the migrations, as in production
+    tmpdir = tempfile.mkdtemp(prefix='myacars-plans-')
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(
+        tmpdir, 'plans.db')
+    try:
+        upgrade(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'migrations'))
+        engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+        check_plans(engine)
+    finally:
+        app.config['SQLALCHEMY_DATABASE_URI'] = uri
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def check_plans(engine):
+    @listens_for(engine, 'before_cursor_execute', retval=True)
+    def explain(conn, cursor, statement, parameters, context, executemany):
+        return 'EXPLAIN QUERY PLAN ' + statement, parameters
+
+    queries = [
+        ('get_active_position', Position.active_position_query()),
+        ('active_positions', Position.get_active_positions()),
+        ('flight_positions', Position.query.filter(
+            Position.flight_id == 1
+        ).order_by(Position.timestamp)),
+        ('positions_after', positions_after(1, 100)),
+        ('extend_stop', extend_stop_statement(dict(
+            {i: 0 for i in redundant_fields}, flight_id=1,
+            timestamp=datetime.utcnow()))),
+        ('session_lookup', Session.query.filter_by(sessionid='sessionid')),
+        ('airport_lookup', Airport.query.filter_by(icao='SBGR')),
+        ('bid_flights', Flight.query.filter(Flight.landing_rate.is_(None),
+                                            Flight.log.is_(None))),
+        ('complete_flights', Flight.complete_flights().order_by(
+            Flight.id.desc())),
+    ]
+
+    failed = []
+    with engine.connect() as conn:
+        for name, query in queries:
+            statement = getattr(query, 'statement', query)
+            plan = [row[-1] for row in conn.execute(statement)]
+            scans = [i for i in plan if re_full_scan.match(i) and
+                     not re_allowed_scan.match(i)]
+            print('%s %s: %s' % ('FAIL' if scans else 'ok', name,
+                                 '; '.join(plan)))
+            if scans:
+                failed.append(name)
+    if failed:
+        raise SystemExit('Full scans found: %s' % ', '.join(failed))
+
 
 if __name__ == '__main__':
     manager.run()
@@ -70,9 +70,18 @@ var plane = null;
 var route = null;
 
 var chart = null;
+var chart_points = 500;
+var x_list = [];
 var altitude_list = [];
 var ground_speed_list = [];
 
+var position_cursor = null;
+var positions_loading = false;
+var positions_pending = false;
+// positions appended from the live stream since the cursor, replaced by the
+// stored ones on the next catch up
+var delta_count = 0;
+
 function initialize_flight(geojson_url, data) {
     source = new ol.source.Vector({
         format: new ol.format.GeoJSON(),
@@ -162,16 +171,21 @@ function initialize_flight(geojson_url, data) {
             source.forEachFeature(function(feature) {
                 if (feature.get('type') === 'plane') {
                     plane = feature;
+                    position_cursor = feature.get('cursor');
                 }
                 if (feature.get('type') === 'route') {
                     route = feature;
                     var flight_data = feature.get('flight_data');
-                    altitude_list = flight_data[0];
-                    ground_speed_list = flight_data[1];
+                    chart_points = feature.get('chart_points');
+                    x_list = flight_data[0];
+                    altitude_list = flight_data[1];
+                    ground_speed_list = flight_data[2];
                     chart = c3.generate({
                         bindto: '#flight_data',
                         data: {
+                            x: 'x',
                             columns: [
+                                x_list,
                                 altitude_list,
                                 ground_speed_list
                             ],
@@ -181,7 +195,12 @@ function initialize_flight(geojson_url, data) {
                         },
                         axis: {
                             x: {
-                                show: false
+                                type: 'timeseries',
+                                localtime: false,
+                                tick: {
+                                    format: '%H:%M',
+                                    count: 8
+                                }
                             },
                             y: {
                                 tick: {
@@ -213,111 +232,369 @@ function initialize_flight(geojson_url, data) {
             });
             view.fit(source.getExtent(), map.getSize());
             ol.Observable.unByKey(change_key);
+            // positions reported while the track was loading
+            if (live_data !== null) {
+                load_positions(live_data);
+            }
         }
     });
 }
 
 var live_initialized = false;
+var live_data = null;
 
-function refresh_live() {
-
-    function update_flight(data) {
-        if (!live_initialized) {
-            $("#not-live").hide();
-            $("#live-details").show();
-            initialize_flight(data.geojson_url, data);
-            $("#flight-title").html(data.html_title);
-            $("#origin").html(data.origin);
-            $("#destination").html(data.destination);
-            $("#aircraft").html(data.aircraft);
-            $("#flight-level").html('FL' + data.flight_level);
-            live_initialized = true;
+// Updates the live page. Deltas from the live stream carry the new position,
+// anything else catches up through the cursor, e.g. after a reconnect.
+function update_flight(data, delta) {
+    live_data = data;
+    if (!live_initialized) {
+        $("#not-live").hide();
+        $("#live-details").show();
+        initialize_flight(data.geojson_url, data);
+        initialize_live_flights();
+        $("#flight-title").html(data.html_title);
+        $("#origin").html(data.origin);
+        $("#destination").html(data.destination);
+        $("#aircraft").html(data.aircraft);
+        $("#flight-level").html('FL' + data.flight_level);
+        live_initialized = true;
+    }
+    if (plane !== null && chart !== null) {
+        if (delta) {
+            append_position(data);
         }
-        if (plane !== null && chart !== null) {
-            var coord = ol.proj.fromLonLat([
-                data.longitude,
-                data.latitude,
-            ]);
-            route.getGeometry().appendCoordinate(coord);
-            plane.getGeometry().setCoordinates(coord);
-            var style = plane.getStyle();
-            if (style === null) {
-                style = new ol.style.Style({
-                    image: get_plane_icon(data)
-                });
-                plane.setStyle(style);
-            }
-            else {
-                style.setImage(get_plane_icon(data));
-            }
-            altitude_list.push(data.altitude);
-            ground_speed_list.push(data.ground_speed);
-            chart.load({
-                columns: [
-                    altitude_list,
-                    ground_speed_list,
-                ]
-            });
+        else {
+            load_positions(data);
+        }
+    }
+    if (live_initialized) {
+        if (data.ofp_url) {
+            $("#ofp").show();
+            $("#ofp-url").attr("href", data.ofp_url);
+        }
+        else {
+            $("#ofp").hide();
+        }
+        $("#route").html(data.route);
+        if (data.diversion) {
+            $("#diversion").show();
+            $("#diversion-airport").html(data.diversion);
+        }
+        else {
+            $("#diversion").hide();
+        }
+        if (data.metrics) {
+            $("#distance").show();
+            $("#distance-flown").text(data.metrics.distance + ' nm');
+        }
+        else {
+            $("#distance").hide();
+        }
+        if (data.near) {
+            $("#near").show();
+            $("#near-airport").text(data.near.distance + ' nm from ' +
+                                    data.near.icao + ' - ' + data.near.name);
         }
-        if (live_initialized) {
-            if (data.ofp_url) {
-                $("#ofp").show();
-                $("#ofp-url").attr("href", data.ofp_url);
+        else {
+            $("#near").hide();
+        }
+    }
+}
+
+// Keeps the chart within twice the point budget of the server, dropping
+// every other older point once it is exceeded. The most recent points are
+// kept as reported.
+function compact_chart() {
+    var count = x_list.length - 1;
+    if (count <= 2 * chart_points) {
+        return;
+    }
+    var recent = count - Math.max(Math.floor(chart_points / 2), delta_count);
+    function compact(list) {
+        var rv = [list[0]];
+        for (var i = 1; i <= count; i++) {
+            if (i > recent || i % 2 === 1) {
+                rv.push(list[i]);
             }
-            else {
-                $("#ofp").hide();
+        }
+        return rv;
+    }
+    x_list = compact(x_list);
+    altitude_list = compact(altitude_list);
+    ground_speed_list = compact(ground_speed_list);
+}
+
+function update_plane(data) {
+    plane.getGeometry().setCoordinates(ol.proj.fromLonLat([
+        data.longitude,
+        data.latitude,
+    ]));
+    var style = plane.getStyle();
+    if (style === null) {
+        style = new ol.style.Style({
+            image: get_plane_icon(data)
+        });
+        plane.setStyle(style);
+    }
+    else {
+        style.setImage(get_plane_icon(data));
+    }
+}
+
+function load_chart() {
+    compact_chart();
+    chart.load({
+        columns: [
+            x_list,
+            altitude_list,
+            ground_speed_list,
+        ]
+    });
+}
+
+// Appends the position carried by a live stream delta.
+function append_position(data) {
+    route.getGeometry().appendCoordinate(ol.proj.fromLonLat([
+        data.longitude,
+        data.latitude,
+    ]));
+    x_list.push(Math.round(data.timestamp * 1000));
+    altitude_list.push(data.altitude);
+    ground_speed_list.push(data.ground_speed);
+    delta_count++;
+    load_chart();
+    update_plane(data);
+}
+
+// Replaces the positions appended from the live stream with the ones stored
+// since the cursor, so none are lost after a reconnect or a gap.
+function load_positions(data) {
+    if (positions_loading) {
+        positions_pending = true;
+        return;
+    }
+    positions_loading = true;
+    var appended = delta_count;
+    var url = '/flight/' + data.id + '/positions/?after=' +
+        (position_cursor || 0);
+    $.getJSON(url, function(result) {
+        if (plane === null || chart === null || result.id !== data.id) {
+            return;
+        }
+        var fields = {};
+        $.each(result.fields, function(i, name) {
+            fields[name] = i;
+        });
+        var coordinates = [], x = [], altitude = [], ground_speed = [];
+        $.each(result.positions, function(i, row) {
+            coordinates.push(ol.proj.fromLonLat([
+                row[fields.longitude],
+                row[fields.latitude],
+            ]));
+            x.push(Math.round(row[fields.timestamp] * 1000));
+            altitude.push(row[fields.altitude]);
+            ground_speed.push(row[fields.ground_speed]);
+        });
+        // deltas received while loading stay after the stored positions
+        var later = delta_count - appended;
+        function replace(list, items) {
+            var end = list.length - later;
+            return list.slice(0, end - appended).concat(
+                items, list.slice(end));
+        }
+        var geometry = route.getGeometry();
+        geometry.setCoordinates(replace(geometry.getCoordinates(),
+                                        coordinates));
+        x_list = replace(x_list, x);
+        altitude_list = replace(altitude_list, altitude);
+        ground_speed_list = replace(ground_speed_list, ground_speed);
+        delta_count = later;
+        position_cursor = result.cursor;
+        if (appended > 0 || result.positions.length > 0) {
+            load_chart();
+        }
+        update_plane(data);
+    }).always(function() {
+        positions_loading = false;
+        if (positions_pending) {
+            positions_pending = false;
+            if (live_data !== null) {
+                load_positions(live_data);
             }
-            $("#route").html(data.route);
         }
+    });
+}
+
+// Other flights reporting positions, restricted to the visible map area.
+var flights_source = null;
+
+function initialize_live_flights() {
+    flights_source = new ol.source.Vector();
+    map.addLayer(new ol.layer.Vector({
+        source: flights_source
+    }));
+    map.on('moveend', refresh_live_flights);
+}
+
+function normalize_longitude(lon) {
+    return ((lon + 180) % 360 + 360) % 360 - 180;
+}
+
+function refresh_live_flights() {
+    if (map === null || flights_source === null) {
+        return;
+    }
+    var extent = ol.proj.transformExtent(
+        map.getView().calculateExtent(map.getSize()),
+        'EPSG:3857', 'EPSG:4326');
+    var west = -180, east = 180;
+    if (extent[2] - extent[0] < 360) {
+        west = normalize_longitude(extent[0]);
+        east = normalize_longitude(extent[2]);
+    }
+    var bbox = [west, extent[1], east, extent[3]].join(',');
+    $.getJSON('/live/flights/', {bbox: bbox}, function(data) {
+        if (flights_source === null) {
+            return;
+        }
+        flights_source.clear();
+        $.each(data.flights, function(i, flight) {
+            if (live_data !== null && flight.id === live_data.id) {
+                return;
+            }
+            var feature = new ol.Feature({
+                geometry: new ol.geom.Point(ol.proj.fromLonLat([
+                    flight.longitude,
+                    flight.latitude,
+                ])),
+                title: flight.html_title
+            });
+            feature.setStyle(new ol.style.Style({
+                image: get_plane_icon(flight)
+            }));
+            flights_source.addFeature(feature);
+        });
+    });
+}
+
+function reset_flight() {
+    live_data = null;
+    if (live_initialized) {
+        $("#live-details").hide();
+        $("#ofp").hide();
+        $("#not-live").show();
+        $("#map").html("");
+        $("#flight_data").html("");
+        live_initialized = false;
+        map = null;
+        source = null;
+        plane = null;
+        route = null;
+        chart = null;
+        x_list = [];
+        altitude_list = [];
+        ground_speed_list = [];
+        position_cursor = null;
+        delta_count = 0;
+        flights_source = null;
     }
+}
 
+function refresh_live() {
     $.getJSON('/live/json/', function(data) {
         if (data.live) {
             update_flight(data);
         }
         else {
-            if (live_initialized) {
-                $("#live-details").hide();
-                $("#ofp").hide();
-                $("#not-live").show();
-                $("#map").html("");
-                $("#flight_data").html("");
-                live_initialized = false;
-                map = null;
-                source = null;
-                plane = null;
-                route = null;
-                chart = null;
-                altitude_list = [];
-                ground_speed_list = [];
-            }
+            reset_flight();
         }
     });
 }
 
 
-function initialize_live() {
-    refresh_live();
-    window.setInterval(refresh_live, 15000);
+// Subscribes to the live stream, falling back to polling /live/json/ if
+// the browser or the server doesn't support Server-Sent Events.
+function subscribe_live(on_start, on_position, on_end, refresh) {
+    function poll() {
+        refresh();
+        window.setInterval(refresh, 15000);
+    }
+
+    if (!window.EventSource) {
+        poll();
+        return;
+    }
+    var stream = new EventSource('/live/stream/');
+    stream.addEventListener('start', function(e) {
+        on_start(JSON.parse(e.data));
+    });
+    stream.addEventListener('position', function(e) {
+        on_position(JSON.parse(e.data));
+    });
+    stream.addEventListener('end', function(e) {
+        on_end(JSON.parse(e.data));
+    });
+    stream.onerror = function() {
+        // the browser reconnects by itself, unless the request failed
+        if (stream.readyState === EventSource.CLOSED) {
+            poll();
+        }
+    };
 }
 
 
-function refresh_online() {
-    var online = $("#card-online"), offline = $("#card-offline");
-    $.getJSON('/live/json/', function(data) {
-        if (data.live) {
-            offline.hide();
-            online.show();
+function initialize_live() {
+    subscribe_live(update_flight, function(data) {
+        if (live_data !== null && live_data.id === data.id) {
+            update_flight($.extend({}, live_data, data), true);
         }
         else {
-            online.hide();
-            offline.show();
+            refresh_live();
+        }
+    }, function(data) {
+        // other flights may end while this one is live, the initial state
+        // of the stream carries no id when nothing is live at all
+        if (live_data !== null &&
+                (data.id === undefined || live_data.id === data.id)) {
+            reset_flight();
         }
+    }, refresh_live);
+    window.setInterval(refresh_live_flights, 15000);
+}
+
+
+function show_online(live) {
+    if (live) {
+        $("#card-offline").hide();
+        $("#card-online").show();
+    }
+    else {
+        $("#card-online").hide();
+        $("#card-offline").show();
+    }
+}
+
+
+function refresh_online() {
+    $.getJSON('/live/json/', function(data) {
+        show_online(data.live);
     });
 }
 
 
 function initialize_online() {
-    refresh_online();
-    window.setInterval(refresh_online, 15000);
+    var live_id = null;
+    subscribe_live(function(data) {
+        live_id = data.id;
+        show_online(true);
+    }, function(data) {
+        live_id = data.id;
+        show_online(true);
+    }, function(data) {
+        if (data.id === undefined || live_id === null ||
+                data.id === live_id) {
+            live_id = null;
+            show_online(false);
+        }
+    }, refresh_online);
 }